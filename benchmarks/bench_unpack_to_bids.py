@@ -0,0 +1,405 @@
+#!/usr/bin/python
+
+"""
+bench_unpack_to_bids.py
+
+  Author: Tom Morin
+    Date: March, 2019
+ Purpose: Time the stages of unpack_to_bids.py on synthetic sessions (see
+          synthetic.py), with a stub dcm2niix, and save the results so that
+          versions can be compared on the same machine. Whole sessions
+          (session[...]) go through convert_session, and are the measure to
+          compare across versions. The benchmarks of single stages call
+          internal functions, and are skipped where a version lacks them.
+"""
+
+################################################################################
+#
+# IMPORT USEFUL PYTHON MODULES
+#
+################################################################################
+import sys
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import bids_validate
+import unpack_to_bids
+import synthetic
+
+################################################################################
+#
+# DEFINE CONSTANT VARIABLES
+#
+################################################################################
+STUB_BIN_DIR = os.path.join(BENCH_DIR, 'bin')  # Holds the stub dcm2niix
+BENCHMARKS = ['copy_to_bids', 'check_filenames', 'intended_for', 'sidecars', 'validate_dataset', 'session']
+
+# Functions each benchmark calls. Benchmarks whose functions are missing in the
+# version being measured are skipped.
+BENCHMARK_REQUIRES = {'copy_to_bids': ['unpack_to_bids.build_unpacked_inventory', 'unpack_to_bids.build_run_registry',
+                                       'unpack_to_bids.resolve_intended_for', 'unpack_to_bids.copy_to_bids'],
+                      'check_filenames': ['unpack_to_bids.check_filenames'],
+                      'intended_for': ['unpack_to_bids.build_run_registry', 'unpack_to_bids.resolve_intended_for'],
+                      'sidecars': ['unpack_to_bids.build_unpacked_inventory', 'unpack_to_bids.build_run_registry',
+                                   'unpack_to_bids.resolve_intended_for', 'unpack_to_bids.rewrite_sidecar'],
+                      'validate_dataset': ['bids_validate.validate_dataset'],
+                      'session': ['unpack_to_bids.convert_session']}
+MODULES = {'unpack_to_bids': unpack_to_bids, 'bids_validate': bids_validate}
+MB = 1024 * 1024
+
+################################################################################
+#
+# IMPLEMENT USEFUL FUNCTIONS
+#
+################################################################################
+# Call fn loops times in a row, repeat times, calling setup (not timed) before
+# each repeat. Returns the seconds per call of each repeat.
+def measure(fn, repeat, loops = 1, setup = None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for j in range(loops):
+            fn()
+        times.append((time.perf_counter() - start) / loops)
+    return times
+
+# Summarize the times of one benchmark, with the amount of work done per call
+# (bytes and files) and any other details
+def summarize(times, loops = 1, **details):
+    result = {'times': [round(t, 6) for t in times],
+              'min': round(min(times), 6),
+              'median': round(statistics.median(times), 6),
+              'mean': round(statistics.mean(times), 6),
+              'loops': loops}
+    result.update(details)
+    return result
+
+def fresh_dir(dpath):
+    shutil.rmtree(dpath, ignore_errors=True)
+    os.makedirs(dpath)
+
+def touch(fpath):
+    with open(fpath, 'a'):
+        pass
+
+# Return the functions required by a benchmark that this version does not have
+def missing_functions(name):
+    return [required for required in BENCHMARK_REQUIRES[name]
+            if not hasattr(MODULES[required.split(".")[0]], required.split(".")[1])]
+
+# Describe the code and machine being measured
+def environment():
+    def git(*argv):
+        try:
+            proc = subprocess.run(["git", "-C", REPO_DIR] + list(argv), stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, universal_newlines=True)
+        except OSError:
+            return None
+        return proc.stdout.strip() if proc.returncode == 0 else None
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {'commit': git("rev-parse", "--short", "HEAD"),
+            'dirty': None if status is None else status != "",
+            'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+# Generate the synthetic sessions: one per subject, with its runs and
+# --intended_for groups. The UNPACKED directory of the first session is used by
+# the benchmarks of single stages; DICOM directories are only written for
+# whole-session runs.
+def make_sessions(args, work_dir, with_dicoms):
+    sessions = []
+    for i in range(args.subjects):
+        sub = "%03d" % (i + 1)
+        runs, intended_for = synthetic.session_runs(sub, "1", args.func, args.fmap, args.dwi)
+        session = {'sub': sub,
+                   'sess': "1",
+                   'runs': runs,
+                   'runs_by_type': synthetic.runs_by_datatype(runs),
+                   'intended_for': intended_for,
+                   'input_dir': os.path.join(work_dir, 'input', 'sub-' + sub, 'scans')}
+        if with_dicoms:
+            synthetic.make_dicom_tree(session['input_dir'], runs, int(args.series_mb * MB), args.dicoms)
+        sessions.append(session)
+    synthetic.make_unpacked_tree(os.path.join(work_dir, 'UNPACKED'), sessions[0]['runs'], int(args.series_mb * MB))
+    return sessions
+
+# runs_by_type as convert_session builds it, from the --anat/--func/--dwi/--fmap lists
+def runs_by_type(session):
+    return [(img_type, session['runs_by_type'][img_type]) for img_type in ['anat', 'fmap', 'func', 'dwi']]
+
+def fmap_apply_names(session):
+    registry = unpack_to_bids.build_run_registry(runs_by_type(session), session['sess'], ".nii")
+    return unpack_to_bids.resolve_intended_for(registry, session['intended_for'])
+
+# Put the first session's UNPACKED files into a BIDS session directory with
+# copy_to_bids, by copy, hardlink and gzip compression
+def bench_copy_to_bids(args, work_dir, sessions, results):
+    session = sessions[0]
+    unpacked_dir = os.path.join(work_dir, 'UNPACKED')
+    inventory = unpack_to_bids.build_unpacked_inventory(unpacked_dir)
+    fmap_apply = fmap_apply_names(session)
+    nii_bytes = sum(os.path.getsize(f) for (series, ext), paths in inventory.items() if ext == ".nii" for f in paths)
+    num_files = sum(len(paths) for paths in inventory.values())
+    for variant, placement, gzip_level in [('copy', 'copy', None),
+                                           ('hardlink', 'hardlink', None),
+                                           ('gzip', 'copy', args.gzip_level)]:
+        sess_dir = os.path.join(work_dir, 'copy_to_bids', variant)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as block_pool:
+            # Options of every version since the benchmarks were added; each reads the ones it uses
+            place_opts = {'placement': placement,
+                          'gzip_level': gzip_level,
+                          'block_pool': block_pool,
+                          'block_slots': threading.BoundedSemaphore(2 * args.jobs)}
+
+            def place():
+                for img_type, runs in runs_by_type(session):
+                    unpack_to_bids.copy_to_bids(runs, img_type, sess_dir, inventory, fmap_apply, place_opts)
+
+            times = measure(place, args.repeat, setup=lambda: fresh_dir(sess_dir))
+        results['copy_to_bids[' + variant + ']'] = summarize(times, bytes=nii_bytes, files=num_files)
+
+# Check the filenames of every session against the BIDS grammar, as done
+# before each conversion
+def bench_check_filenames(args, work_dir, sessions, results):
+    all_runs = [item for session in sessions for item in runs_by_type(session)]
+    times = measure(lambda: unpack_to_bids.check_filenames(all_runs, ".nii"), args.repeat, args.loops)
+    results['check_filenames'] = summarize(times, args.loops, files=sum(len(runs) for img_type, runs in all_runs))
+
+# Register the runs of every session and resolve their --intended_for groups
+def bench_intended_for(args, work_dir, sessions, results):
+    def resolve():
+        for session in sessions:
+            fmap_apply_names(session)
+    times = measure(resolve, args.repeat, args.loops)
+    results['intended_for'] = summarize(times, args.loops, files=sum(len(session['runs']) for session in sessions))
+
+# Rewrite the first session's dcm2niix sidecars into the BIDS tree, with their
+# TaskName and IntendedFor edits
+def bench_sidecars(args, work_dir, sessions, results):
+    session = sessions[0]
+    unpacked_dir = os.path.join(work_dir, 'UNPACKED')
+    inventory = unpack_to_bids.build_unpacked_inventory(unpacked_dir)
+    fmap_apply = fmap_apply_names(session)
+    sess_dir = os.path.join(work_dir, 'sidecars')
+    sidecars = [(inventory[(run['series'], ".json")][0], run) for run in session['runs']]
+
+    def rewrite():
+        for src, run in sidecars:
+            unpack_to_bids.rewrite_sidecar(src, os.path.join(sess_dir, run['fname'] + ".json"),
+                                           run['datatype'], run['fname'], fmap_apply)
+    times = measure(rewrite, args.repeat, args.loops, setup=lambda: fresh_dir(sess_dir))
+    results['sidecars'] = summarize(times, args.loops, bytes=sum(os.path.getsize(src) for src, run in sidecars),
+                                    files=len(sidecars))
+
+# Validate a dataset holding every session (with empty files), in full and
+# incrementally when nothing changed
+def bench_validate_dataset(args, work_dir, sessions, results):
+    bids_dir = os.path.join(work_dir, 'validate')
+    fresh_dir(bids_dir)
+    num_files = 0
+    for session in sessions:
+        for run in session['runs']:
+            dpath = os.path.join(bids_dir, 'sub-' + session['sub'], 'ses-' + session['sess'], run['datatype'])
+            os.makedirs(dpath, exist_ok=True)
+            for ext in [".nii", ".json"]:
+                touch(os.path.join(dpath, run['fname'] + ext))
+                num_files += 1
+    times = measure(lambda: bids_validate.validate_dataset(bids_dir, incremental=False), args.repeat)
+    results['validate_dataset[full]'] = summarize(times, files=num_files)
+    bids_validate.validate_dataset(bids_dir)
+    times = measure(lambda: bids_validate.validate_dataset(bids_dir), args.repeat)
+    results['validate_dataset[incremental]'] = summarize(times, files=num_files)
+
+# Convert every session into a new dataset with convert_session and the stub
+# dcm2niix, without the conversion cache and then from a warm cache. The
+# per-stage times are totalled from the run reports of the last repeat, for
+# versions that return one.
+def bench_session(args, work_dir, sessions, results):
+    os.makedirs(os.path.join(work_dir, 'scratch'), exist_ok=True)
+    dicom_bytes = sum(os.path.getsize(os.path.join(root, f))
+                      for session in sessions for root, dirs, fnames in os.walk(session['input_dir']) for f in fnames)
+    for variant, options in [('no_cache', {'no_cache': True}),
+                             ('cached', {'cache_dir': os.path.join(work_dir, 'cache')})]:
+        output_dir = os.path.join(work_dir, 'bids-' + variant)
+        stages = {}
+
+        def convert():
+            stages.clear()
+            for session in sessions:
+                result = unpack_to_bids.convert_session(session['sub'], session['sess'], session['input_dir'], output_dir,
+                                                        intended_for=session['intended_for'],
+                                                        jobs=args.jobs,
+                                                        scratch=os.path.join(work_dir, 'scratch'),
+                                                        **dict(session['runs_by_type'], **options))
+                for stage, totals in result.get('report', {}).get('stages', {}).items():
+                    stage_totals = stages.setdefault(stage, {'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0})
+                    for field in stage_totals:
+                        stage_totals[field] += totals[field]
+
+        if variant == 'cached':
+            fresh_dir(output_dir)
+            convert()
+        times = measure(convert, args.repeat, setup=lambda: fresh_dir(output_dir))
+        for totals in stages.values():
+            totals['seconds'] = round(totals['seconds'], 6)
+        results['session[' + variant + ']'] = summarize(times, bytes=dicom_bytes, sessions=len(sessions), stages=stages)
+
+BENCHMARK_FUNCTIONS = {'copy_to_bids': bench_copy_to_bids,
+                       'check_filenames': bench_check_filenames,
+                       'intended_for': bench_intended_for,
+                       'sidecars': bench_sidecars,
+                       'validate_dataset': bench_validate_dataset,
+                       'session': bench_session}
+
+def print_results(results, baseline = None):
+    print("\n%-32s %10s %10s %10s %10s" % ("BENCHMARK", "MIN (s)", "MEDIAN (s)", "MB/s",
+                                           "VS BASE" if baseline is not None else ""))
+    for name, result in results.items():
+        rate = "%.1f" % (result['bytes'] / MB / result['min']) if result.get('bytes') and result['min'] > 0 else ""
+        change = ""
+        if baseline is not None and name in baseline and baseline[name]['min'] > 0:
+            change = "%.2fx" % (result['min'] / baseline[name]['min'])
+        print("%-32s %10.6f %10.6f %10s %10s" % (name, result['min'], result['median'], rate, change))
+
+def load_results(fpath):
+    with open(fpath) as infile:
+        return json.load(infile)
+
+################################################################################
+#
+# MAIN SCRIPT
+#
+################################################################################
+def main():
+    # ==========================================================================
+    # Parse input arguments (also specify help info)
+    # ==========================================================================
+    parser = argparse.ArgumentParser(
+        description="Benchmark unpack_to_bids.py on synthetic sessions. Times are per call; " +
+                    "VS BASE is the ratio of the minimum time to that of --compare (below 1 is faster).")
+    parser.add_argument('--subjects',
+                        type=int,
+                        default=3,
+                        help="subjects in the synthetic dataset, with one session each (default: 3)")
+    parser.add_argument('--func',
+                        type=int,
+                        default=6,
+                        help="functional runs per session (default: 6)")
+    parser.add_argument('--fmap',
+                        type=int,
+                        default=1,
+                        help="pairs of AP/PA fieldmaps per session (default: 1)")
+    parser.add_argument('--dwi',
+                        type=int,
+                        default=1,
+                        help="diffusion runs per session (default: 1)")
+    parser.add_argument('--series_mb',
+                        type=float,
+                        default=8,
+                        help="megabytes of image data per series (default: 8)")
+    parser.add_argument('--dicoms',
+                        type=int,
+                        default=50,
+                        help="DICOM files per series (default: 50)")
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help="times each benchmark is run (default: 3)")
+    parser.add_argument('--loops',
+                        type=int,
+                        default=100,
+                        help="calls per run of the fast benchmarks (check_filenames, intended_for, sidecars) " +
+                             "(default: 100)")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help="dcm2niix processes and compression threads (default: up to 4)")
+    parser.add_argument('--gzip_level',
+                        type=int,
+                        default=6,
+                        help="compression level of copy_to_bids[gzip] (default: 6)")
+    parser.add_argument('--only',
+                        nargs='+',
+                        choices=BENCHMARKS,
+                        help="run only these benchmarks")
+    parser.add_argument('--work_dir',
+                        help="directory for the synthetic data (default: a new directory in $TMPDIR, " +
+                             "removed when done). Put it on the filesystem to be measured.")
+    parser.add_argument('-o', '--output',
+                        help="save the results to this JSON file")
+    parser.add_argument('--compare',
+                        nargs='+',
+                        metavar='RESULTS',
+                        help="compare with saved results: OLD.json compares this run with it, " +
+                             "OLD.json NEW.json compares two saved runs without running anything")
+    args = parser.parse_args()
+
+    if args.compare is not None and len(args.compare) > 2:
+        sys.exit("ERROR: --compare takes at most two results files")
+    if args.compare is not None and len(args.compare) == 2:
+        old, new = [load_results(fpath) for fpath in args.compare]
+        for label, data in [("Baseline", old), ("Compared", new)]:
+            print(label + ": " + json.dumps(data['environment'], sort_keys=True))
+        print_results(new['results'], old['results'])
+        return
+    for name in ['subjects', 'func', 'dicoms', 'repeat', 'loops', 'jobs']:
+        if getattr(args, name) < 1:
+            sys.exit("ERROR: --" + name + " must be at least 1")
+    baseline = load_results(args.compare[0])['results'] if args.compare is not None else None
+
+    # Quiet unpack_to_bids, and put the stub dcm2niix first on the PATH
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.ERROR)
+    os.environ['PATH'] = STUB_BIN_DIR + os.pathsep + os.environ.get('PATH', "")
+
+    # ==========================================================================
+    # Generate the synthetic sessions and run the benchmarks
+    # ==========================================================================
+    benchmarks = args.only or BENCHMARKS
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="bench_unpack_to_bids-", dir=args.work_dir)
+    results = {}
+    try:
+        print("Generating " + str(args.subjects) + " synthetic session(s) in " + work_dir)
+        sessions = make_sessions(args, work_dir, 'session' in benchmarks)
+        for name in benchmarks:
+            missing = missing_functions(name)
+            if len(missing) > 0:
+                print("Skipping " + name + ": this version has no " + ", ".join(missing))
+                continue
+            print("Running " + name)
+            BENCHMARK_FUNCTIONS[name](args, work_dir, sessions, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results, baseline)
+    if args.output is not None:
+        scale = dict((name, getattr(args, name))
+                     for name in ['subjects', 'func', 'fmap', 'dwi', 'series_mb', 'dicoms', 'repeat', 'loops', 'jobs',
+                                  'gzip_level'])
+        with open(args.output, 'w') as outfile:
+            json.dump({'environment': environment(), 'scale': scale, 'results': results}, outfile,
+                      indent=4, sort_keys=True)
+            outfile.write("\n")
+        print("\nSaved results to " + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+"""
+synthetic.py
+
+  Author: Tom Morin
+    Date: March, 2019
+ Purpose: Generate synthetic scan sessions for the benchmarks: DICOM directories
+          with one N-DESC directory per series (as exported by XNAT), and the
+          files dcm2niix writes for them into UNPACKED
+"""
+
+################################################################################
+#
+# IMPORT USEFUL PYTHON MODULES
+#
+################################################################################
+import json
+import os
+import random
+
+################################################################################
+#
+# DEFINE CONSTANT VARIABLES
+#
+################################################################################
+# Values used by the stub dcm2niix for the %i (patient ID) and %t (time) fields
+# of its output names
+STUB_PATIENT_ID = "BENCH"
+STUB_TIME = "20200101120000"
+STUB_VERSION = "v1.0.20190902 (benchmark stub)"
+
+# Series descriptions, which tell the stub dcm2niix which files to write
+ANAT_DESC = "T1wMPRAGE"
+FMAP_DESCS = ["SpinEchoFieldMapAP", "SpinEchoFieldMapPA"]
+FUNC_DESC = "BOLDrest"
+DWI_DESC = "DWI"
+
+# Image data: half noise and half zeros, so it compresses about 2:1 like MRI data
+DATA_BLOCK = random.Random(0).getrandbits(8 * 32768).to_bytes(32768, 'little') + bytes(32768)
+
+################################################################################
+#
+# IMPLEMENT USEFUL FUNCTIONS
+#
+################################################################################
+# Lay out the runs of one session: a T1w, num_fmap pairs of AP/PA fieldmaps,
+# num_func BOLD runs and num_dwi diffusion runs, numbered as consecutive series.
+# Returns a list of runs, each a dict with the series number, series description
+# (desc), BIDS datatype and filename (fname), and the --intended_for groups
+# (fieldmap pair k applies to every num_fmap-th functional run, from run k).
+def session_runs(sub, sess, num_func, num_fmap = 1, num_dwi = 1):
+    prefix = "sub-" + sub + "_ses-" + sess
+    runs = [{'datatype': 'anat', 'desc': ANAT_DESC, 'fname': prefix + "_T1w"}]
+    for k in range(num_fmap):
+        for direction, desc in zip(["AP", "PA"], FMAP_DESCS):
+            runs.append({'datatype': 'fmap', 'desc': desc,
+                         'fname': prefix + "_dir-" + direction + "_run-" + str(k + 1) + "_epi"})
+    for i in range(num_func):
+        runs.append({'datatype': 'func', 'desc': FUNC_DESC + str(i + 1),
+                     'fname': prefix + "_task-rest_run-" + str(i + 1) + "_bold"})
+    for i in range(num_dwi):
+        runs.append({'datatype': 'dwi', 'desc': DWI_DESC + str(i + 1), 'fname': prefix + "_run-" + str(i + 1) + "_dwi"})
+    for series, run in enumerate(runs, start=1):
+        run['series'] = series
+
+    fmaps = [run['series'] for run in runs if run['datatype'] == 'fmap']
+    funcs = [run['series'] for run in runs if run['datatype'] == 'func']
+    intended_for = []
+    for k in range(num_fmap):
+        targets = funcs[k::num_fmap]
+        intended_for.append([fmaps[2 * k]] + targets)
+        intended_for.append([fmaps[2 * k + 1]] + targets)
+    return runs, intended_for
+
+# Runs in the form of the --anat/--func/--dwi/--fmap options: {datatype: [[RUN_NUM, FILENAME], ...]}
+def runs_by_datatype(runs):
+    by_type = dict((datatype, []) for datatype in ['anat', 'func', 'dwi', 'fmap'])
+    for run in runs:
+        by_type[run['datatype']].append([str(run['series']), run['fname']])
+    return by_type
+
+# Write size bytes of image data to fpath
+def fill_file(fpath, size):
+    with open(fpath, 'wb') as outfile:
+        while size > 0:
+            block = DATA_BLOCK[:size]
+            outfile.write(block)
+            size -= len(block)
+
+# Write the DICOM directory of a session into input_dir: one N-DESC/DICOM
+# directory per series holding files_per_series files, series_bytes in all
+def make_dicom_tree(input_dir, runs, series_bytes, files_per_series):
+    for run in runs:
+        dpath = os.path.join(input_dir, str(run['series']) + "-" + run['desc'], "DICOM")
+        os.makedirs(dpath, exist_ok=True)
+        for i in range(files_per_series):
+            size = series_bytes // files_per_series + (1 if i < series_bytes % files_per_series else 0)
+            fill_file(os.path.join(dpath, "IM%05d.dcm" % (i + 1)), size)
+
+# Name of a dcm2niix output for the -f pattern, e.g. %i_%p_%t_%s
+def output_name(pattern, series, desc):
+    return (pattern.replace("%i", STUB_PATIENT_ID).replace("%p", desc)
+                   .replace("%t", STUB_TIME).replace("%s", str(series)))
+
+# A dcm2niix-like JSON sidecar, with the slice timing of functional runs
+def sidecar(series, desc):
+    data = {'Modality': 'MR',
+            'MagneticFieldStrength': 3,
+            'Manufacturer': 'Siemens',
+            'ManufacturersModelName': 'Prisma_fit',
+            'InstitutionName': 'Synthetic',
+            'SeriesDescription': desc,
+            'ProtocolName': desc,
+            'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND'],
+            'SeriesNumber': series,
+            'AcquisitionTime': '12:00:00.000000',
+            'SliceThickness': 2.4,
+            'EchoTime': 0.03,
+            'RepetitionTime': 2.0,
+            'FlipAngle': 90,
+            'PhaseEncodingDirection': 'j-',
+            'ConversionSoftware': 'dcm2niix',
+            'ConversionSoftwareVersion': STUB_VERSION}
+    if desc.startswith(FUNC_DESC):
+        data['SliceTiming'] = [round((i * 37 % 60) / 30.0, 5) for i in range(60)]
+    return data
+
+# Write the dcm2niix outputs of one series into out_dir: a .nii of image data
+# (the contents of data_files if given, otherwise nii_bytes of synthetic data),
+# a .json sidecar, and .bval/.bvec files for diffusion series. Returns the paths.
+def write_outputs(out_dir, pattern, series, desc, data_files = None, nii_bytes = 0):
+    stem = os.path.join(out_dir, output_name(pattern, series, desc))
+    if data_files is None:
+        fill_file(stem + ".nii", nii_bytes)
+    else:
+        with open(stem + ".nii", 'wb') as outfile:
+            for fpath in data_files:
+                with open(fpath, 'rb') as infile:
+                    for block in iter(lambda: infile.read(1 << 20), b''):
+                        outfile.write(block)
+    with open(stem + ".json", 'w') as outfile:
+        json.dump(sidecar(series, desc), outfile, indent=4)
+    outputs = [stem + ".nii", stem + ".json"]
+    if desc.startswith(DWI_DESC):
+        with open(stem + ".bval", 'w') as outfile:
+            outfile.write(" ".join(["0"] + ["1000"] * 64) + "\n")
+        with open(stem + ".bvec", 'w') as outfile:
+            for axis in range(3):
+                outfile.write(" ".join(["0"] + ["%.6f" % ((i * (axis + 3) % 17) / 17.0) for i in range(64)]) + "\n")
+        outputs += [stem + ".bval", stem + ".bvec"]
+    return outputs
+
+# Write the UNPACKED directory dcm2niix would produce for a session, without
+# going through DICOM files
+def make_unpacked_tree(unpacked_dir, runs, series_bytes, pattern = "%i_%p_%t_%s"):
+    os.makedirs(unpacked_dir, exist_ok=True)
+    outputs = []
+    for run in runs:
+        outputs += write_outputs(unpacked_dir, pattern, run['series'], run['desc'], nii_bytes=series_bytes)
+    return outputs
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+
+"""
+bids_validate.py
+
+  Author: Tom Morin
+    Date: March, 2019
+ Purpose: Check that filenames in a BIDS dataset follow the BIDS entity grammar,
+          reporting every problem in one pass. Whole datasets are validated
+          incrementally: only files changed since the last run are re-checked.
+"""
+
+################################################################################
+#
+# IMPORT USEFUL PYTHON MODULES
+#
+################################################################################
+import sys
+import argparse
+import json
+import logging
+import os
+import re
+import dataset_metadata
+
+################################################################################
+#
+# DEFINE CONSTANT VARIABLES
+#
+################################################################################
+logger = logging.getLogger('bids_validate')
+
+# Entities in the order they must appear in a filename, and the kind of value
+# each one takes ('label': alphanumeric, 'index': digits)
+ENTITY_ORDER = ['sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo']
+ENTITY_KINDS = {'sub': 'label', 'ses': 'label', 'task': 'label', 'acq': 'label', 'ce': 'label',
+                'rec': 'label', 'dir': 'label', 'run': 'index', 'mod': 'label', 'echo': 'index'}
+ENTITY_NAMES = {'sub': 'Subject', 'ses': 'Session', 'task': 'Task', 'acq': 'Acquisition',
+                'ce': 'Contrast Enhancement', 'rec': 'Reconstruction', 'dir': 'DIR', 'run': 'Run',
+                'mod': 'Modalities Ref', 'echo': 'Echo'}
+
+# Entities, required entities, suffixes and file extensions allowed for each datatype
+DATATYPE_RULES = {
+    'anat': {'entities': ['sub', 'ses', 'acq', 'ce', 'rec', 'run', 'mod'],
+             'required': ['sub'],
+             'suffixes': ['T1w', 'T2w', 'T1rho', 'T1map', 'T2map', 'T2star', 'FLAIR', 'FLASH', 'PD',
+                          'PDT2', 'inplaneT1', 'inplaneT2', 'angio', 'defacemask', 'SWImagandphase'],
+             'extensions': ['.nii', '.nii.gz', '.json']},
+    'func': {'entities': ['sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'echo'],
+             'required': ['sub', 'task'],
+             'suffixes': ['bold', 'sbref', 'events', 'physio', 'stim'],
+             'extensions': ['.nii', '.nii.gz', '.json', '.tsv', '.tsv.gz']},
+    'dwi':  {'entities': ['sub', 'ses', 'acq', 'dir', 'run'],
+             'required': ['sub'],
+             'suffixes': ['dwi', 'sbref'],
+             'extensions': ['.nii', '.nii.gz', '.json', '.bval', '.bvec']},
+    'fmap': {'entities': ['sub', 'ses', 'acq', 'ce', 'dir', 'run'],
+             'required': ['sub'],
+             'suffixes': ['phasediff', 'magnitude', 'phase1', 'phase2', 'magnitude1', 'magnitude2',
+                          'fieldmap', 'epi'],
+             'extensions': ['.nii', '.nii.gz', '.json']},
+}
+
+# Suffixes that are only allowed with some extensions (e.g. events.tsv, never events.nii)
+SUFFIX_EXTENSIONS = {'events': ['.tsv'],
+                     'physio': ['.tsv.gz', '.json'],
+                     'stim': ['.tsv.gz', '.json']}
+
+# Datatypes where an unknown suffix only produces a warning
+WARN_ONLY_DATATYPES = ['fmap']
+
+# Where the incremental validation index is kept, relative to the dataset root
+INDEX_PATH = os.path.join('.unpack_to_bids', 'validate_index.json')
+INDEX_VERSION = 2  # Bump when the checks change, so that stored results are redone
+
+################################################################################
+#
+# COMPILE THE ENTITY GRAMMAR
+#
+################################################################################
+VALUE_PATTERNS = {'label': '[a-zA-Z0-9]+', 'index': '[0-9]+'}
+LABEL_PATTERN = re.compile(r'^[a-zA-Z0-9]+$')
+INDEX_PATTERN = re.compile(r'^[0-9]+$')
+EXT_PATTERN = re.compile(r'^(?P<name>[^.]*)(?P<ext>\..*)?$')
+
+# Compile one datatype's rules into a single regular expression that matches
+# every valid filename (without extension), plus lookup tables used to explain
+# why an invalid filename does not match
+def compile_rules(rules):
+    pattern = '^'
+    for entity in rules['entities']:
+        optional = '' if entity in rules['required'] else '?'
+        prefix = '' if entity == 'sub' else '_'
+        pattern += '(?:' + prefix + entity + '-' + VALUE_PATTERNS[ENTITY_KINDS[entity]] + ')' + optional
+    pattern += '_(?:' + '|'.join(re.escape(s) for s in rules['suffixes']) + ')$'
+    return {'regex': re.compile(pattern),
+            'position': dict((e, ENTITY_ORDER.index(e)) for e in rules['entities']),
+            'required': rules['required'],
+            'suffixes': frozenset(rules['suffixes']),
+            'extensions': frozenset(rules['extensions'])}
+
+GRAMMAR = dict((datatype, compile_rules(rules)) for datatype, rules in DATATYPE_RULES.items())
+
+################################################################################
+#
+# IMPLEMENT USEFUL FUNCTIONS
+#
+################################################################################
+# Explain why a filename does not match its datatype's grammar. Returns lists of
+# error and warning messages; the name is split into entities only here, on the
+# slow path.
+def diagnose_filename(name, datatype, grammar):
+    errors = []
+    warnings = []
+    tokens = name.split('_')
+    suffix = tokens.pop() if len(tokens) > 0 and '-' not in tokens[-1] else None
+
+    found = {}
+    last_position = -1
+    for token in tokens:
+        parts = token.split('-')
+        if len(parts) != 2 or parts[0] == '' or parts[1] == '':
+            errors.append("'" + token + "' is not a key-value pair like 'run-1'")
+            continue
+        entity, value = parts
+        if entity not in grammar['position']:
+            errors.append("'" + entity + "' entity is not allowed for " + datatype + " images. Choose from: " +
+                          str(sorted(grammar['position'], key=ENTITY_ORDER.index)))
+            continue
+        if entity in found:
+            errors.append("'" + entity + "' entity appears more than once")
+            continue
+        found[entity] = value
+        if ENTITY_KINDS[entity] == 'label' and LABEL_PATTERN.match(value) is None:
+            errors.append(ENTITY_NAMES[entity] + " tag " + value + " contains non-alphanumeric characters")
+        elif ENTITY_KINDS[entity] == 'index' and INDEX_PATTERN.match(value) is None:
+            errors.append(ENTITY_NAMES[entity] + " tag " + value + " must only contain digits")
+        if grammar['position'][entity] < last_position:
+            errors.append("'" + entity + "' entity is out of order. Entities must appear in the order: " +
+                          ", ".join(e for e in ENTITY_ORDER if e in grammar['position']))
+        last_position = max(last_position, grammar['position'][entity])
+
+    if len(tokens) == 0 or not tokens[0].startswith('sub-'):
+        errors.append("Filename should start with 'sub-PARTICIPANT' tag")
+    for entity in grammar['required']:
+        if entity != 'sub' and entity not in found:
+            errors.append(datatype + " filename must contain '" + entity + "-' tag")
+
+    if suffix is None:
+        errors.append("Could not find modality tag at the end of the filename, e.g. '" +
+                      sorted(grammar['suffixes'])[0] + "'")
+    elif suffix not in grammar['suffixes']:
+        message = suffix + " not supported for " + datatype + " images. Choose from: " + \
+                  str(sorted(grammar['suffixes']))
+        if datatype in WARN_ONLY_DATATYPES:
+            warnings.append(message)
+        else:
+            errors.append(message)
+    return errors, warnings
+
+# Check a filename against the BIDS grammar for a datatype (anat, func, dwi or
+# fmap). The extension is optional. Returns lists of error and warning messages.
+def validate_filename(fname, datatype):
+    grammar = GRAMMAR.get(datatype)
+    if grammar is None:
+        return ["Unknown datatype '" + datatype + "'. Choose from: " + str(sorted(GRAMMAR))], []
+    match = EXT_PATTERN.match(fname)
+    name, ext = match.group('name'), match.group('ext')
+    errors = []
+    if ext is not None and ext not in grammar['extensions']:
+        errors.append("'" + ext + "' files are not allowed in " + datatype + ". Choose from: " +
+                      str(sorted(grammar['extensions'])))
+    suffix = name.rsplit('_', 1)[-1]
+    if ext is not None and suffix in SUFFIX_EXTENSIONS and ext not in SUFFIX_EXTENSIONS[suffix]:
+        errors.append("'" + suffix + "' files must have one of the extensions: " + str(SUFFIX_EXTENSIONS[suffix]))
+    # Fast path: a single regular expression match for valid names
+    if grammar['regex'].match(name) is not None:
+        return errors, []
+    more_errors, warnings = diagnose_filename(name, datatype, grammar)
+    return errors + more_errors, warnings
+
+# Check one file of a dataset, given its path relative to the dataset root.
+# Returns lists of error and warning messages. The bytes of sidecars read are
+# counted into stats.
+def validate_dataset_file(bids_dir, relpath, stats = None):
+    parts = relpath.split(os.sep)
+    fname = parts[-1]
+    sub = parts[0]
+    ses = parts[1] if len(parts) > 1 and parts[1].startswith('ses-') else None
+    session_level = 2 if ses is not None else 1
+
+    # Per-subject sessions file, e.g. sub-01/sub-01_sessions.tsv, and per-session
+    # scans file, e.g. sub-01/ses-1/sub-01_ses-1_scans.tsv (sub-01/sub-01_scans.tsv
+    # in datasets without sessions)
+    if len(parts) == session_level + 1:
+        expected = [sub + ('_' + ses if ses is not None else '') + '_scans']
+        if ses is None:
+            expected.append(sub + '_sessions')
+        if fname in [name + ext for name in expected for ext in ['.tsv', '.json']]:
+            return [], []
+        return ["Unexpected file. Only " + " or ".join(name + ".tsv" for name in expected) + 
+                " may be stored here"], []
+    if len(parts) != session_level + 2:
+        return ["Unexpected location. Files must be stored in sub-<label>/[ses-<label>/]<datatype>/"], []
+
+    datatype = parts[session_level]
+    if datatype not in GRAMMAR:
+        return [], ["Datatype '" + datatype + "' is not checked by this validator"]
+    errors, warnings = validate_filename(fname, datatype)
+    if not fname.startswith(sub + '_'):
+        errors.append("Filename does not start with '" + sub + "_' like its directory")
+    if ses is not None and '_' + ses + '_' not in fname:
+        errors.append("Filename does not contain '" + ses + "' like its directory")
+
+    # Sidecars must be readable JSON, and functional sidecars need a TaskName
+    if fname.endswith('.json'):
+        try:
+            with open(os.path.join(bids_dir, relpath)) as infile:
+                dataset_metadata.count_io(stats, bytes_read=os.fstat(infile.fileno()).st_size)
+                data = json.load(infile)
+        except ValueError as e:
+            errors.append("Invalid JSON: " + str(e))
+        else:
+            if datatype == 'func' and fname.endswith('_bold.json') and 'TaskName' not in data:
+                errors.append("Sidecar is missing the TaskName field")
+    return errors, warnings
+
+# List the subject files of a dataset with their modification time and size
+def scan_dataset(bids_dir):
+    files = {}
+    for entry in os.scandir(bids_dir):
+        if not entry.is_dir() or not entry.name.startswith('sub-'):
+            continue
+        for root, dirs, fnames in os.walk(entry.path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for fname in fnames:
+                if fname.startswith('.'):
+                    continue
+                fpath = os.path.join(root, fname)
+                st = os.stat(fpath)
+                files[os.path.relpath(fpath, bids_dir)] = [st.st_mtime_ns, st.st_size]
+    return files
+
+def load_index(bids_dir, stats = None):
+    try:
+        with open(os.path.join(bids_dir, INDEX_PATH)) as infile:
+            dataset_metadata.count_io(stats, bytes_read=os.fstat(infile.fileno()).st_size)
+            data = json.load(infile)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+        return {}
+    return data['files']
+
+# Save the index atomically, so that concurrent runs never read a partial index
+def save_index(bids_dir, index, stats = None):
+    fpath = os.path.join(bids_dir, INDEX_PATH)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    text = json.dumps({'version': INDEX_VERSION, 'files': index})
+    dataset_metadata.write_atomic(fpath, text)
+    dataset_metadata.count_io(stats, bytes_written=len(text.encode()))
+
+# Validate a whole dataset. With incremental=True, only files whose modification
+# time or size changed since the last run are re-checked; results for the other
+# files come from the stored index. Returns (problems, checked), where problems
+# maps relative paths to (errors, warnings) and checked counts re-checked files.
+# The bytes read and written are counted into stats (see dataset_metadata.count_io).
+def validate_dataset(bids_dir, incremental = True, stats = None):
+    problems = {}
+    errors = []
+    fpath = os.path.join(bids_dir, 'dataset_description.json')
+    try:
+        with open(fpath) as infile:
+            dataset_metadata.count_io(stats, bytes_read=os.fstat(infile.fileno()).st_size)
+            data = json.load(infile)
+        for key in ['Name', 'BIDSVersion']:
+            if key not in data:
+                errors.append("Missing the " + key + " field")
+    except OSError:
+        errors.append("File is missing")
+    except ValueError as e:
+        errors.append("Invalid JSON: " + str(e))
+    if len(errors) > 0:
+        problems['dataset_description.json'] = (errors, [])
+
+    old_index = load_index(bids_dir, stats) if incremental else {}
+    index = {}
+    checked = 0
+    for relpath, stamp in scan_dataset(bids_dir).items():
+        entry = old_index.get(relpath)
+        if entry is None or entry[:2] != stamp:
+            entry = stamp + list(validate_dataset_file(bids_dir, relpath, stats))
+            checked += 1
+        index[relpath] = entry
+        if len(entry[2]) > 0 or len(entry[3]) > 0:
+            problems[relpath] = (entry[2], entry[3])
+    save_index(bids_dir, index, stats)
+    return problems, checked
+
+# Log the problems found by validate_dataset. Returns the number of errors.
+def print_problems(problems):
+    num_errors = 0
+    for relpath in sorted(problems):
+        errors, warnings = problems[relpath]
+        for message in errors:
+            logger.error("ERROR: " + relpath + ": " + message)
+        for message in warnings:
+            logger.warning("WARNING: " + relpath + ": " + message)
+        num_errors += len(errors)
+    return num_errors
+
+################################################################################
+#
+# MAIN SCRIPT
+#
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bids_dir',
+                        help="BIDS dataset to validate")
+    parser.add_argument('--full',
+                        action='store_true',
+                        help="re-check every file, ignoring the stored index of previously checked files")
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
+
+    problems, checked = validate_dataset(args.bids_dir, incremental=not args.full)
+    num_errors = print_problems(problems)
+    print("Checked " + str(checked) + " new or changed file(s). Found " + str(num_errors) + " error(s).")
+    if num_errors > 0:
+        sys.exit(1)
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+
+"""
+dataset_metadata.py
+
+  Author: Tom Morin
+    Date: March, 2019
+ Purpose: Create and update the dataset-level files of a BIDS dataset
+          (dataset_description.json, README, CHANGES, participants.tsv) and the
+          per-session scans.tsv files, safely from many sessions at once
+"""
+
+################################################################################
+#
+# IMPORT USEFUL PYTHON MODULES
+#
+################################################################################
+import sys
+import argparse
+import contextlib
+import csv
+import datetime
+import fcntl
+import io
+import json
+import logging
+import os
+import threading
+
+################################################################################
+#
+# DEFINE CONSTANT VARIABLES
+#
+################################################################################
+BIDS_VERSION = "1.0.2"
+
+# Kept inside the dataset, next to the other unpack_to_bids state
+STATE_DIR = '.unpack_to_bids'
+LOCK_PATH = os.path.join(STATE_DIR, 'dataset.lock')
+CHANGES_LOG_PATH = os.path.join(STATE_DIR, 'changes.jsonl')
+
+logger = logging.getLogger('dataset_metadata')
+
+# Imaging files listed in scans.tsv
+SCANS_EXTS = ['.nii', '.nii.gz']
+
+################################################################################
+#
+# IMPLEMENT USEFUL FUNCTIONS
+#
+################################################################################
+# Hold an exclusive lock on the dataset while updating its shared files. POSIX
+# record locks also work between hosts on NFS.
+@contextlib.contextmanager
+def dataset_lock(bids_dir):
+    fpath = os.path.join(bids_dir, LOCK_PATH)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(fpath, 'a') as lockfile:
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+
+# Add file data read and written to stats, a dict with bytes_read,
+# bytes_written and files (e.g. a stage of the unpack_to_bids.py --report).
+# Nothing is counted when stats is None.
+def count_io(stats, bytes_read = 0, bytes_written = 0, files = 0):
+    if stats is not None:
+        stats['bytes_read'] += bytes_read
+        stats['bytes_written'] += bytes_written
+        stats['files'] += files
+
+# Write text to fpath atomically: write a temporary file in the same directory,
+# then rename it over fpath, so readers never see a partial file
+def write_atomic(fpath, text, stats = None):
+    tmp = os.path.join(os.path.dirname(fpath),
+                       "." + os.path.basename(fpath) + "." + str(os.getpid()) + "." +
+                       str(threading.get_ident()) + ".tmp")
+    try:
+        with open(tmp, 'x') as outfile:
+            outfile.write(text)
+        os.replace(tmp, fpath)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    count_io(stats, bytes_written=len(text.encode()), files=1)
+
+def read_tsv(fpath, stats = None):
+    try:
+        with open(fpath, newline='') as infile:
+            count_io(stats, bytes_read=os.fstat(infile.fileno()).st_size)
+            reader = csv.DictReader(infile, delimiter='\t')
+            return list(reader.fieldnames or []), list(reader)
+    except FileNotFoundError:
+        return [], []
+
+def write_tsv(fpath, columns, rows, stats = None):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, columns, delimiter='\t', restval='n/a', extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+    write_atomic(fpath, out.getvalue(), stats)
+
+# Append one record to the change log. Records are only ever appended, with a
+# single write, so concurrent sessions never rewrite each other's entries.
+def append_change(bids_dir, record, stats = None):
+    fpath = os.path.join(bids_dir, CHANGES_LOG_PATH)
+    data = (json.dumps(record, sort_keys=True) + "\n").encode()
+    fd = os.open(fpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    count_io(stats, bytes_written=len(data), files=1)
+
+def read_changes(bids_dir, stats = None):
+    records = []
+    try:
+        with open(os.path.join(bids_dir, CHANGES_LOG_PATH)) as infile:
+            count_io(stats, bytes_read=os.fstat(infile.fileno()).st_size)
+            for line in infile:
+                if line.strip() != "":
+                    records.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return records
+
+# Create or update dataset_description.json, README and the code directory, and
+# log a change. The first change of a new dataset is its initial release; after
+# that, the given (version, description) is logged. An existing CHANGES file
+# written before the change log existed is kept as the oldest entry.
+# The files read and written are counted into stats (see count_io).
+def update_dataset(bids_dir, proj_name, change, stats = None):
+    with dataset_lock(bids_dir):
+        # Create or update dataset_description.json
+        fpath = os.path.join(bids_dir, 'dataset_description.json')
+        if not os.path.exists(fpath):
+            logger.info("Creating dataset_description.json file")
+            data = {'Name': proj_name}
+        else:
+            logger.info("Updating existing dataset_description.json file")
+            with open(fpath) as infile:
+                count_io(stats, bytes_read=os.fstat(infile.fileno()).st_size)
+                data = json.load(infile)
+        data['BIDSVersion'] = BIDS_VERSION
+        write_atomic(fpath, json.dumps(data, indent=4), stats)
+
+        # Create or update README
+        logger.info("Creating README")
+        now = datetime.datetime.now()
+        write_atomic(os.path.join(bids_dir, 'README'),
+                     "Project Name: " + proj_name + "\n" +
+                     "BIDS Version: " + BIDS_VERSION + "\n" +
+                     "This project was unpacked and put into BIDS format by unpack_to_bids.py on " +
+                     now.strftime("%Y-%m-%d %H:%M") + "\n", stats)
+
+        # Log the change; CHANGES itself is only written by render_changes
+        today = str(datetime.date.today())
+        if len(read_changes(bids_dir, stats)) == 0:
+            changes_path = os.path.join(bids_dir, 'CHANGES')
+            if os.path.exists(changes_path):
+                with open(changes_path) as infile:
+                    legacy = infile.read()
+                count_io(stats, bytes_read=len(legacy.encode()))
+                append_change(bids_dir, {'legacy': legacy}, stats)
+            else:
+                logger.info("Logging initial release in the change log")
+                append_change(bids_dir, {'version': '1.0.0', 'date': today, 'description': 'Initial release.'}, stats)
+                change = None
+        if change is not None:
+            logger.info("Logging the change specified by the --change option:\n" + change[1])
+            append_change(bids_dir, {'version': change[0], 'date': today, 'description': change[1]}, stats)
+
+        # Make "code directory"
+        fpath = os.path.join(bids_dir, 'code')
+        if not os.path.exists(fpath):
+            logger.info("Creating code directory")
+            os.makedirs(fpath, exist_ok=True)
+
+# Render CHANGES from the change log, newest version first. Sessions logging the
+# same version and description (e.g. a batch run with one --change) give one entry.
+def render_changes(bids_dir, stats = None):
+    with dataset_lock(bids_dir):
+        records = read_changes(bids_dir, stats)
+        if len(records) == 0:
+            return 0
+        versions = []
+        entries = {}
+        legacy = ""
+        for record in records:
+            if 'legacy' in record:
+                legacy = record['legacy']
+                continue
+            if record['version'] not in entries:
+                versions.append(record['version'])
+                entries[record['version']] = {'date': record['date'], 'descriptions': []}
+            entry = entries[record['version']]
+            entry['date'] = max(entry['date'], record['date'])
+            if record['description'] not in entry['descriptions']:
+                entry['descriptions'].append(record['description'])
+        text = ""
+        for version in reversed(versions):
+            text += version + " " + entries[version]['date'] + "\n"
+            for description in entries[version]['descriptions']:
+                text += "\t- " + description + "\n"
+        text += legacy
+        write_atomic(os.path.join(bids_dir, 'CHANGES'), text, stats)
+    return len(versions)
+
+# Add a subject to participants.tsv, keeping any columns added by hand
+def add_participant(bids_dir, sub, stats = None):
+    participant_id = 'sub-' + sub
+    with dataset_lock(bids_dir):
+        fpath = os.path.join(bids_dir, 'participants.tsv')
+        columns, rows = read_tsv(fpath, stats)
+        if any(row.get('participant_id') == participant_id for row in rows):
+            return
+        if 'participant_id' not in columns:
+            columns = ['participant_id'] + columns
+        rows.append({'participant_id': participant_id})
+        rows.sort(key=lambda row: row.get('participant_id') or "")
+        logger.info("Adding " + participant_id + " to participants.tsv")
+        write_tsv(fpath, columns, rows, stats)
+
+# Bring the scans.tsv of a session directory up to date with its imaging files:
+# keep the rows (and any extra columns) of files that are still there, and add
+# rows for new files. Only this session writes the file, so no lock is needed.
+def update_scans(sess_dir, sub, sess):
+    fpath = os.path.join(sess_dir, 'sub-' + sub + '_ses-' + sess + '_scans.tsv')
+    columns, rows = read_tsv(fpath)
+    if 'filename' not in columns:
+        columns = ['filename'] + columns
+    fnames = []
+    for datatype in sorted(os.listdir(sess_dir)):
+        if not os.path.isdir(os.path.join(sess_dir, datatype)) or datatype.startswith('.'):
+            continue
+        for fname in sorted(os.listdir(os.path.join(sess_dir, datatype))):
+            if any(fname.endswith(ext) for ext in SCANS_EXTS) and not fname.startswith('.'):
+                fnames.append(datatype + "/" + fname)
+    by_name = dict((row.get('filename'), row) for row in rows)
+    rows = [by_name.get(fname, {'filename': fname}) for fname in fnames]
+    write_tsv(fpath, columns, rows)
+
+################################################################################
+#
+# MAIN SCRIPT
+#
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bids_dir',
+                        help="BIDS dataset whose CHANGES file is written from its change log")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.bids_dir):
+        sys.exit("ERROR: " + args.bids_dir + " is not a directory")
+    num_versions = render_changes(args.bids_dir)
+    print("Wrote " + str(num_versions) + " version(s) to " + os.path.join(args.bids_dir, 'CHANGES'))
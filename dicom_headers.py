@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+"""
+dicom_headers.py
+
+  Author: Tom Morin
+    Date: March, 2019
+ Purpose: Build an inventory of the series in a DICOM directory by reading only
+          the first few kilobytes of one file per series, and map series to
+          BIDS filenames with a rules file
+"""
+
+################################################################################
+#
+# IMPORT USEFUL PYTHON MODULES
+#
+################################################################################
+import sys
+import argparse
+import json
+import os
+import re
+import struct
+
+################################################################################
+#
+# DEFINE CONSTANT VARIABLES
+#
+################################################################################
+# Header fields read from each series, by (group, element) tag
+HEADER_TAGS = {(0x0008, 0x0008): 'ImageType',
+               (0x0008, 0x103E): 'SeriesDescription',
+               (0x0018, 0x1030): 'ProtocolName',
+               (0x0020, 0x0011): 'SeriesNumber'}
+LAST_TAG = max(HEADER_TAGS)
+
+# Explicit VRs whose length is stored in 4 bytes, after 2 reserved bytes
+LONG_VRS = [b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV']
+
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_BIG_ENDIAN = '1.2.840.10008.1.2.2'
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM_TAG = (0xFFFE, 0xE000)
+ITEM_DELIMITATION_TAG = (0xFFFE, 0xE00D)
+SEQUENCE_DELIMITATION_TAG = (0xFFFE, 0xE0DD)
+
+# Bytes read from a file at first; doubled until the header fields are found
+FIRST_READ_SIZE = 16 * 1024
+MAX_READ_SIZE = 4 * 1024 * 1024
+
+# Files in a series directory that are never DICOM images (e.g. XNAT catalogs)
+NON_DICOM_EXTS = ['.xml', '.txt', '.json', '.nii', '.gz', '.bval', '.bvec']
+
+# Archives that can be read in place of a DICOM directory
+ARCHIVE_EXTS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+
+################################################################################
+#
+# IMPLEMENT USEFUL FUNCTIONS
+#
+################################################################################
+# Raised when the bytes read so far end before the wanted header fields
+class NeedMoreData(Exception):
+    pass
+
+# Read the tag, VR and value length of the data element at pos. Returns
+# (tag, vr, length, value_pos); vr is None for implicit VR.
+def read_element_header(buf, pos, explicit):
+    if pos + 8 > len(buf):
+        raise NeedMoreData()
+    group, element = struct.unpack_from('<HH', buf, pos)
+    tag = (group, element)
+    # Item and delimitation tags never have a VR
+    if not explicit or group == 0xFFFE:
+        length, = struct.unpack_from('<I', buf, pos + 4)
+        return tag, None, length, pos + 8
+    vr = bytes(buf[pos + 4:pos + 6])
+    if vr in LONG_VRS:
+        if pos + 12 > len(buf):
+            raise NeedMoreData()
+        length, = struct.unpack_from('<I', buf, pos + 8)
+        return tag, vr, length, pos + 12
+    length, = struct.unpack_from('<H', buf, pos + 6)
+    return tag, vr, length, pos + 8
+
+# Skip a value of undefined length (a sequence, or an item inside one) that
+# starts at pos. Returns the position after its delimitation item.
+def skip_undefined_length(buf, pos, explicit, end_tag):
+    while True:
+        tag, vr, length, pos = read_element_header(buf, pos, explicit)
+        if tag == end_tag:
+            return pos
+        if length == UNDEFINED_LENGTH:
+            nested_end_tag = ITEM_DELIMITATION_TAG if tag == ITEM_TAG else SEQUENCE_DELIMITATION_TAG
+            pos = skip_undefined_length(buf, pos, explicit, nested_end_tag)
+        else:
+            pos += length
+
+def decode_value(value):
+    return bytes(value).decode('ascii', 'replace').strip('\x00 ')
+
+# Parse the wanted header fields from the start of a DICOM file. Raises
+# NeedMoreData if buf ends before they are all found, and ValueError if the
+# bytes are not a DICOM file this reader supports.
+def parse_header(buf):
+    buf = memoryview(buf)
+    header = {}
+    explicit = False
+    pos = 0
+    if bytes(buf[128:132]) == b'DICM':
+        # File meta information (group 0002) is always explicit VR little endian
+        pos = 132
+        transfer_syntax = None
+        while True:
+            if pos + 2 > len(buf):
+                raise NeedMoreData()
+            group, = struct.unpack_from('<H', buf, pos)
+            if group != 0x0002:
+                break
+            tag, vr, length, value_pos = read_element_header(buf, pos, True)
+            if value_pos + length > len(buf):
+                raise NeedMoreData()
+            if tag == (0x0002, 0x0010):
+                transfer_syntax = decode_value(buf[value_pos:value_pos + length])
+            pos = value_pos + length
+        if transfer_syntax in [EXPLICIT_VR_BIG_ENDIAN, DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN]:
+            raise ValueError("Unsupported transfer syntax " + transfer_syntax)
+        explicit = transfer_syntax != IMPLICIT_VR_LITTLE_ENDIAN
+    elif len(buf) < 132:
+        raise NeedMoreData()
+    else:
+        # Files without a preamble: check for a plausible implicit VR group 0008 element
+        group, = struct.unpack_from('<H', buf, 0)
+        if group != 0x0008:
+            raise ValueError("Not a DICOM file")
+
+    while len(header) < len(HEADER_TAGS):
+        tag, vr, length, pos = read_element_header(buf, pos, explicit)
+        if tag > LAST_TAG:
+            break
+        if length == UNDEFINED_LENGTH:
+            pos = skip_undefined_length(buf, pos, explicit, SEQUENCE_DELIMITATION_TAG)
+            continue
+        if tag in HEADER_TAGS:
+            if pos + length > len(buf):
+                raise NeedMoreData()
+            header[HEADER_TAGS[tag]] = decode_value(buf[pos:pos + length])
+        pos += length
+    return header
+
+# Read the wanted header fields from an open binary file, reading only as many
+# bytes as needed. Returns a dict, or None if the file is not a supported DICOM file.
+def read_header_from_file(infile):
+    buf = infile.read(FIRST_READ_SIZE)
+    while True:
+        try:
+            header = parse_header(buf)
+        except NeedMoreData:
+            if len(buf) >= MAX_READ_SIZE:
+                return None
+            more = infile.read(len(buf))
+            if len(more) == 0:
+                return None
+            buf += more
+            continue
+        except (ValueError, struct.error):
+            return None
+        if 'SeriesNumber' in header:
+            header['SeriesNumber'] = int(header['SeriesNumber']) if header['SeriesNumber'].isdigit() else None
+        if 'ImageType' in header:
+            header['ImageType'] = header['ImageType'].split('\\')
+        return header
+
+def read_header(fpath):
+    with open(fpath, 'rb') as infile:
+        return read_header_from_file(infile)
+
+# Return True for files in a series directory that may be DICOM images
+def maybe_dicom(fname):
+    return not fname.startswith('.') and os.path.splitext(fname)[1].lower() not in NON_DICOM_EXTS
+
+# Return True if path is a zip or tar archive file rather than a directory
+def is_archive(path):
+    return os.path.isfile(path) and any(path.lower().endswith(ext) for ext in ARCHIVE_EXTS)
+
+# Build a session inventory: one entry per directory that holds DICOM files,
+# read from the header of its first DICOM file. Each entry is a dict with
+# SeriesNumber, ProtocolName, SeriesDescription, ImageType, Instances and Path.
+# input_dir may also be a zip or tar archive (see scan_archive).
+def scan_session(input_dir):
+    if is_archive(input_dir):
+        return scan_archive(input_dir)
+    inventory = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if d != 'UNPACKED' and not d.startswith('.'))
+        candidates = sorted(f for f in files if maybe_dicom(f))
+        for fname in candidates:
+            header = read_header(os.path.join(root, fname))
+            if header is None:
+                continue
+            inventory.append(make_entry(header, len(candidates), root))
+            break
+    inventory.sort(key=lambda e: (e['SeriesNumber'] is None, e['SeriesNumber'], e['Path']))
+    return inventory
+
+# Build a session inventory from an archive without extracting it. Zip members
+# are opened directly; tar archives are read in one streaming pass, reading the
+# header of the first DICOM member of each directory. Path is archive:directory.
+def scan_archive(archive):
+    import tarfile
+    import zipfile
+    headers = {}
+    counts = {}
+    def add_member(name, open_member):
+        if '/' in name:
+            dirname, fname = name.rsplit('/', 1)
+        else:
+            dirname, fname = '', name
+        if not maybe_dicom(fname) or dirname.split('/')[-1] == 'UNPACKED':
+            return
+        counts[dirname] = counts.get(dirname, 0) + 1
+        if dirname not in headers:
+            with open_member() as infile:
+                header = read_header_from_file(infile)
+            if header is not None:
+                headers[dirname] = header
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for name in sorted(zf.namelist()):
+                if not name.endswith('/'):
+                    add_member(name, lambda: zf.open(name))
+    else:
+        with tarfile.open(archive, 'r|*') as tf:
+            for member in tf:
+                if member.isfile():
+                    add_member(member.name, lambda: tf.extractfile(member))
+    inventory = [make_entry(header, counts[dirname], archive + ":" + dirname) 
+                 for dirname, header in headers.items()]
+    inventory.sort(key=lambda e: (e['SeriesNumber'] is None, e['SeriesNumber'], e['Path']))
+    return inventory
+
+def make_entry(header, instances, path):
+    return {'SeriesNumber': header.get('SeriesNumber'),
+            'ProtocolName': header.get('ProtocolName', ''),
+            'SeriesDescription': header.get('SeriesDescription', ''),
+            'ImageType': header.get('ImageType', []),
+            'Instances': instances,
+            'Path': path}
+
+# Load a rules file: a JSON list of rules (or {"rules": [...]}). Each rule has
+#   match:         header field -> regular expression, all of which must match
+#                  (ImageType is matched against its values joined with "\")
+#   min_instances: optional, skip series with fewer images (e.g. aborted runs)
+#   datatype:      anat, func, dwi or fmap
+#   filename:      BIDS filename, with {sub}, {sess}, {run}, {series} and any named
+#                  groups of the match patterns filled in. {run} counts the series
+#                  matched by this rule, starting at 1.
+# A rules file that cannot be used raises ValueError.
+def load_rules(fpath):
+    with open(fpath) as infile:
+        try:
+            rules = json.load(infile)
+        except ValueError as e:
+            raise ValueError(fpath + " is not valid JSON: " + str(e))
+    if isinstance(rules, dict):
+        rules = rules.get('rules', [])
+    for i, rule in enumerate(rules):
+        for key in ['match', 'datatype', 'filename']:
+            if key not in rule:
+                raise ValueError("Rule " + str(i) + " in " + fpath + " is missing '" + key + "'")
+        if rule['datatype'] not in ['anat', 'func', 'dwi', 'fmap']:
+            raise ValueError("Rule " + str(i) + " in " + fpath + " has unknown datatype '" + rule['datatype'] + "'")
+        rule['patterns'] = dict((field, re.compile(pattern)) for field, pattern in rule['match'].items())
+    return rules
+
+# Return the named groups matched by a rule's patterns (e.g. (?P<dir>AP|PA)),
+# or None if the rule does not match the inventory entry
+def rule_matches(rule, entry):
+    if entry['Instances'] < rule.get('min_instances', 0):
+        return None
+    groups = {}
+    for field, pattern in rule['patterns'].items():
+        value = entry.get(field)
+        if isinstance(value, list):
+            value = '\\'.join(value)
+        match = None if value is None else pattern.search(str(value))
+        if match is None:
+            return None
+        groups.update(match.groupdict())
+    return groups
+
+# Map inventory entries to BIDS filenames with the first matching rule. Returns
+# {datatype: [[RUN_NUM, FILENAME], ...]}, the same run mappings as the
+# --anat/--func/--dwi/--fmap flags, and the BIDS name of each mapped series.
+def apply_rules(inventory, rules, sub, sess):
+    runs = {'anat': [], 'func': [], 'dwi': [], 'fmap': []}
+    names = {}
+    counts = [0] * len(rules)
+    for entry in inventory:
+        if entry['SeriesNumber'] is None or entry['SeriesNumber'] in names:
+            continue
+        for i, rule in enumerate(rules):
+            groups = rule_matches(rule, entry)
+            if groups is not None:
+                counts[i] += 1
+                fname = rule['filename'].format(sub=sub, sess=sess, run=counts[i], 
+                                                series=entry['SeriesNumber'], **groups)
+                runs[rule['datatype']].append([str(entry['SeriesNumber']), fname])
+                names[entry['SeriesNumber']] = rule['datatype'] + "/" + fname
+                break
+    return runs, names
+
+def print_inventory(inventory, names = {}):
+    print("%6s %9s  %-32s %-32s %-28s %s" % ("SERIES", "INSTANCES", "PROTOCOL", "DESCRIPTION", "IMAGE TYPE", "BIDS NAME"))
+    for entry in inventory:
+        series = entry['SeriesNumber']
+        print("%6s %9d  %-32s %-32s %-28s %s" % ("?" if series is None else series, entry['Instances'],
+                                                 entry['ProtocolName'][:32], entry['SeriesDescription'][:32],
+                                                 '\\'.join(entry['ImageType'])[:28], names.get(series, "")))
+
+################################################################################
+#
+# MAIN SCRIPT
+#
+################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir',
+                        help="directory where DICOM images are stored (e.g. output of xnat2proj command), or a zip/tar archive of it")
+    parser.add_argument('-r', '--rules',
+                        help="JSON rules file mapping header fields to BIDS filenames")
+    parser.add_argument('-s', '--sub',
+                        default="SUB",
+                        help="subject ID used to fill in {sub} in the rules")
+    parser.add_argument('-e', '--sess',
+                        default="1",
+                        help="session number used to fill in {sess} in the rules")
+    args = parser.parse_args()
+
+    inventory = scan_session(args.input_dir)
+    names = {}
+    if args.rules is not None:
+        try:
+            rules = load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            sys.exit("ERROR: " + str(e))
+        runs, names = apply_rules(inventory, rules, args.sub, args.sess)
+    print_inventory(inventory, names)
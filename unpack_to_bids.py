@@ -15,202 +15,1526 @@ unpack_to_bids.py
 ################################################################################
 import sys
 import argparse
+import contextlib
 import json
+import logging
 import os
 import shutil
-import datetime
 import re
-import numpy
-import subprocess
+import hashlib
+import tempfile
+import errno
+import fcntl
+import collections
+import queue
+import threading
+import functools
+import time
+import bids_validate
+import dataset_metadata
+# Modules needed only by some stages (subprocess, zipfile, tarfile, zlib, ctypes,
+# concurrent.futures, cProfile and dicom_headers) are imported where they are
+# used, so that importing this module and --help stay fast
 
 ################################################################################
 #
 # DEFINE CONSTANT VARIABLES
 #
 ################################################################################
-BIDS_VERSION = "1.0.2"
+DCM2NIIX_FLAGS = ["-f", "%i_%p_%t_%s", "-z", "n"]
+PLACEMENT_MODES = ['copy', 'hardlink', 'reflink', 'move', 'symlink']
+GZIP_BLOCK_SIZE = 8 * 1024 * 1024  # Bytes of NIfTI data compressed per gzip member
+FICLONE = 0x40049409  # Linux ioctl for copy-on-write file clones (btrfs, XFS)
+AT_FDCWD = -100  # renameat2() arguments, for swapping an old session with a new one
+RENAME_EXCHANGE = 2
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 
+                                 'unpack_to_bids')
+JOURNAL_DIR = os.path.join('.unpack_to_bids', 'journal')  # Per-session journals, inside output_dir
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+REPORT_FIELDS = ['seconds', 'bytes_read', 'bytes_written', 'files']  # Measured for every stage (see --report)
+
+# Messages go through logging; main() prints them to stdout at --log_level
+logger = logging.getLogger('unpack_to_bids')
+REPORT_LOCK = threading.Lock()
 
 ################################################################################
 #
 # IMPLEMENT USEFUL FUNCTIONS
 #
 ################################################################################
+# Raised for bad options and failed conversions, with a message for the user.
+# main() turns it into an error exit; other callers can catch it per session.
+class UnpackError(Exception):
+    pass
+
 # Implement Unix's "touch" command in Pyton to create new blank files
 def touch(path):
     with open(path, 'a'):
         os.utime(path, None)
 
-# Prepend to a text file
-def prepend(filename, line):
-    with open(filename, "r+") as f:
-        content = f.read()
-        f.seek(0,0)
-        f.write(line.rstrip('\r\n') + '\n' + content)
-
 def check_args(args):
-    if args.sub is None:
-        sys.exit("ERROR: No --sub argument specified")
-    if args.sess is None:
-        sys.exit("ERROR: No --sess argument specified")
-    if args.input_dir is None:
-        sys.exit("No --input_dir argument specified")
-    if args.output_dir is None:
-        sys.exit("No --output_dir argument specified")
-
-# Copy scans from XNAT-Unpacked, to BIDS-compliant directory
-def copy_to_bids(runs, img_type, this_sess, fmap_apply = []):
-    print("Copying the following files into " + img_type)
+    import dicom_headers
+    if args.dataset_files_only and args.skip_dataset_files:
+        raise UnpackError("ERROR: --dataset_files_only and --skip_dataset_files cannot be used together")
+    if not args.dataset_files_only and not args.inventory:
+        if args.sub is None:
+            raise UnpackError("ERROR: No --sub argument specified")
+        if args.sess is None:
+            raise UnpackError("ERROR: No --sess argument specified")
+    if not args.dataset_files_only:
+        if args.input_dir is None:
+            raise UnpackError("ERROR: No --input_dir argument specified")
+        if not os.path.isdir(args.input_dir) and not dicom_headers.is_archive(args.input_dir):
+            raise UnpackError("ERROR: --input_dir " + args.input_dir + " is not a directory or a zip/tar archive")
+        if dicom_headers.is_archive(args.input_dir) and args.placement == 'symlink':
+            raise UnpackError("ERROR: --placement symlink cannot be used with an archive --input_dir, " + 
+                              "because the converted files are removed when done")
+    if args.output_dir is None and not args.inventory:
+        raise UnpackError("ERROR: No --output_dir argument specified")
+    if args.jobs < 1:
+        raise UnpackError("ERROR: --jobs must be at least 1")
+    if args.gzip_level < 1 or args.gzip_level > 9:
+        raise UnpackError("ERROR: --gzip_level must be between 1 and 9")
+    if args.gzip and args.placement not in ['copy', 'move']:
+        logger.warning("WARNING: --placement " + args.placement + " does not apply to compressed output. " + 
+              "NIfTI files will be compressed into new files.")
+    if args.cache_size <= 0:
+        raise UnpackError("ERROR: --cache_size must be greater than 0")
+    if args.scratch is not None and not os.path.isdir(args.scratch):
+        raise UnpackError("ERROR: --scratch " + args.scratch + " is not a directory")
+
+# Create or update dataset_description.json, README and the code directory, log
+# the --change entry (see dataset_metadata.py) and record it in the journal.
+# With resume, a run that already logged the same entry (e.g. before it was
+# interrupted) does not log it again. Files read and written are counted into
+# stats (see dataset_metadata.count_io).
+def update_dataset_files(output_dir, proj_name, changes, journal, resume, stats = None):
+    if resume and journal['data'].get('dataset_files') == changes[-1]:
+        logger.info("Dataset-level files were already updated by an earlier run. Skipping.")
+        return
+    dataset_metadata.update_dataset(output_dir, proj_name, changes[-1], stats)
+    journal_stage(journal, 'dataset_files', changes[-1])
+
+# Read a --rules file (see dicom_headers.load_rules)
+def load_rules(fpath):
+    import dicom_headers
+    try:
+        return dicom_headers.load_rules(fpath)
+    except (OSError, ValueError) as e:
+        raise UnpackError("ERROR: Could not use --rules file " + fpath + ": " + str(e))
+
+# Match dcm2niix outputs written with the "%i_%p_%t_%s" naming pattern. The
+# series number (%s) is always the last underscore-separated field.
+UNPACKED_EXTS = ['.nii', '.json', '.bval', '.bvec']
+UNPACKED_PATTERN = re.compile(r'^(?P<stem>.+)_(?P<series>[0-9]+)(?P<ext>\.nii|\.json|\.bval|\.bvec)$')
+
+# Convert a user-specified run number (e.g. "08") into a series number
+def series_number(run_number):
+    if not str(run_number).isdigit():
+        raise UnpackError("ERROR: Run number " + str(run_number) + " must only contain digits")
+    return int(run_number)
+
+# Index dcm2niix outputs, mapping (series number, extension) to the list of
+# output files for that series
+def index_unpacked_files(fpaths):
+    inventory = {}
+    for fpath in fpaths:
+        match = UNPACKED_PATTERN.match(os.path.basename(fpath))
+        if match is None:
+            continue
+        key = (int(match.group('series')), match.group('ext'))
+        inventory.setdefault(key, []).append(fpath)
+    return inventory
+
+# Index the UNPACKED directory once
+def build_unpacked_inventory(unpacked_dir):
+    return index_unpacked_files(os.path.join(unpacked_dir, f) for f in os.listdir(unpacked_dir))
+
+# Report requested series that are missing from the inventory (warning) or that
+# match more than one dcm2niix output in unpacked_dir (error), before anything
+# is copied
+def check_inventory(inventory, unpacked_dir, runs_by_type):
+    missing = []
+    ambiguous = []
+    for img_type, runs in runs_by_type:
+        for run in runs:
+            series = series_number(run[0])
+            if (series, '.nii') not in inventory and (series, '.json') not in inventory:
+                missing.append(img_type + " run " + run[0] + " (" + run[1] + ")")
+            for ext in UNPACKED_EXTS:
+                matches = inventory.get((series, ext), [])
+                if len(matches) > 1:
+                    ambiguous.append(img_type + " run " + run[0] + " matches " + 
+                                     ", ".join(sorted(os.path.basename(m) for m in matches)))
+    if len(missing) > 0:
+        logger.warning("WARNING: No dcm2niix output found for the following series:\n----" + 
+              "\n----".join(missing))
+    if len(ambiguous) > 0:
+        raise UnpackError("ERROR: More than one dcm2niix output found for the following series:\n----" + 
+                          "\n----".join(ambiguous))
+
+# Match series directories in an XNAT scans tree (e.g. "18" or "18-rfMRI_REST")
+SERIES_DIR_PATTERN = re.compile(r'^(?P<series>[0-9]+)(?:[-_].*)?$')
+
+# Find the directories in input_dir that hold the requested series
+def find_series_dirs(input_dir, series_numbers):
+    series_dirs = {}
+    for d in sorted(os.listdir(input_dir)):
+        match = SERIES_DIR_PATTERN.match(d)
+        if match is None or not os.path.isdir(os.path.join(input_dir, d)):
+            continue
+        series = int(match.group('series'))
+        if series not in series_numbers:
+            continue
+        if series in series_dirs:
+            raise UnpackError("ERROR: More than one directory found for series " + str(series) + ": " + 
+                              os.path.basename(series_dirs[series]) + ", " + d)
+        series_dirs[series] = os.path.join(input_dir, d)
+    return series_dirs
+
+# Run dcm2niix on a single directory. Returns the exit code and captured output,
+# so that output from concurrent conversions is not interleaved.
+def run_dcm2niix(src_dir, unpacked_dir):
+    import subprocess
+    proc = subprocess.run(["dcm2niix"] + DCM2NIIX_FLAGS + ["-o", unpacked_dir, src_dir], 
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+                          universal_newlines=True)
+    return proc.returncode, proc.stdout
+
+# Return the version string reported by dcm2niix, used as part of the cache key
+def dcm2niix_version():
+    import subprocess
+    proc = subprocess.run(["dcm2niix", "--version"], 
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
+                          universal_newlines=True)
+    for line in proc.stdout.splitlines():
+        if "version" in line:
+            return line.strip()
+    return proc.stdout.strip()
+
+# List the DICOM files of a series directory as (relative path, size,
+# modification time) for the cache key
+def dir_fingerprint(series_dir):
+    files = []
+    for root, dirs, fnames in os.walk(series_dir):
+        dirs.sort()
+        for f in sorted(fnames):
+            st = os.stat(os.path.join(root, f))
+            files.append((os.path.relpath(os.path.join(root, f), series_dir), st.st_size, st.st_mtime_ns))
+    return files
+
+# Fingerprint the DICOM files of a series (relative path, size and modification
+# time, plus a hash of the contents if requested) together with the dcm2niix
+# version and flags. Equal fingerprints give equal dcm2niix outputs.
+def series_cache_key(source, cache):
+    files = source['files'] if source['files'] is not None else dir_fingerprint(source['dir'])
+    key = hashlib.sha256()
+    key.update((cache['version'] + "\n" + " ".join(DCM2NIIX_FLAGS) + "\n").encode())
+    for relpath, size, stamp in files:
+        key.update((relpath + "\0" + str(size) + "\0" + str(stamp) + "\n").encode())
+        # Members of zip archives are not extracted yet; their CRC is part of the stamp
+        if cache['hash'] and source.get('dir') is not None:
+            with open(os.path.join(source['dir'], relpath), 'rb') as infile:
+                for block in iter(lambda: infile.read(1 << 20), b''):
+                    key.update(block)
+    return key.hexdigest()
+
+# Hardlink a file if possible (e.g. same filesystem), otherwise copy it
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Clone a file with a copy-on-write reflink if possible, otherwise copy it.
+# Cache entries never share an inode with files that may end up in a dataset
+# (e.g. with --placement hardlink or move), where an edit would change the cache.
+def reflink_or_copy(src, dst):
+    try:
+        reflink(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Restore the outputs of a cached conversion into unpacked_dir. Returns the
+# restored paths, or None on a cache miss. An entry that disappears while it is
+# restored (evicted by another run) is a cache miss too.
+def cache_restore(cache, key, unpacked_dir):
+    entry = os.path.join(cache['dir'], key)
+    outputs = []
+    try:
+        for f in os.listdir(entry):
+            dst = os.path.join(unpacked_dir, f)
+            if os.path.exists(dst):
+                os.remove(dst)
+            outputs.append(dst)
+            reflink_or_copy(os.path.join(entry, f), dst)
+        # Mark the entry as recently used for LRU eviction
+        os.utime(entry, None)
+    except OSError:
+        for dst in outputs:
+            if os.path.exists(dst):
+                os.remove(dst)
+        return None
+    return outputs
+
+# Store the outputs of a conversion in the cache. The entry is written to a
+# temporary directory first and renamed into place, so readers never see a
+# partial entry.
+def cache_store(cache, key, outputs_dir):
+    os.makedirs(cache['dir'], exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(prefix=".tmp-" + key + "-", dir=cache['dir'])
+    try:
+        for f in os.listdir(outputs_dir):
+            reflink_or_copy(os.path.join(outputs_dir, f), os.path.join(tmp_entry, f))
+        os.rename(tmp_entry, os.path.join(cache['dir'], key))
+    except OSError:
+        # Another run stored the same entry first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+# Remove the least recently used cache entries until the cache fits in its size cap
+def cache_evict(cache):
+    if not os.path.isdir(cache['dir']):
+        return
+    entries = []
+    total = 0
+    for key in os.listdir(cache['dir']):
+        entry = os.path.join(cache['dir'], key)
+        if key.startswith(".tmp-") or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError:
+            continue  # Evicted by another run meanwhile
+        total += size
+    for mtime, size, entry in sorted(entries):
+        if total <= cache['max_bytes']:
+            break
+        logger.debug("---- Evicting cache entry " + os.path.basename(entry))
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+# Return the series number of an archive member, taken from the last directory
+# in its path named like a series directory (e.g. "scans/18-rest/DICOM/1.dcm"),
+# along with that directory and the member's path inside it
+def archive_member_series(name):
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts:
+        return None, None, None
+    for i in range(len(parts) - 2, -1, -1):
+        match = SERIES_DIR_PATTERN.match(parts[i])
+        if match is not None:
+            return int(match.group('series')), '/'.join(parts[:i + 1]), '/'.join(parts[i + 1:])
+    return None, None, None
+
+# Find the requested series in a zip archive. Zip archives can be read at random,
+# so members are only extracted when their series is converted (see stage_zip_series).
+def zip_series_sources(archive, series_numbers, scratch_dir):
+    import zipfile
+    groups = {}
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if info.filename.endswith('/'):
+                continue
+            series, prefix, relpath = archive_member_series(info.filename)
+            if series not in series_numbers:
+                continue
+            # The CRC stands in for a content hash in the cache key
+            stamp = "%04d%02d%02d%02d%02d%02d-%08x" % (info.date_time + (info.CRC,))
+            groups.setdefault(series, {}).setdefault(prefix, []).append((info.filename, relpath, info.file_size, stamp))
+    not_found = sorted(set(series_numbers) - set(groups))
+    if len(not_found) > 0:
+        logger.warning("WARNING: No series directory found in " + archive + " for series: " + 
+              ", ".join(str(s) for s in not_found))
+    for series in sorted(groups):
+        if len(groups[series]) > 1:
+            raise UnpackError("ERROR: More than one directory found in " + archive + " for series " + str(series) + ": " + 
+                              ", ".join(sorted(groups[series])))
+        prefix, members = list(groups[series].items())[0]
+        yield series, {'label': archive + ":" + prefix, 
+                       'zip': archive, 
+                       'prefix': prefix, 
+                       'members': [(name, relpath) for name, relpath, size, stamp in members], 
+                       'files': sorted((relpath, size, stamp) for name, relpath, size, stamp in members), 
+                       'scratch': scratch_dir}
+
+# Make a new staging directory in scratch_dir for an archived series directory.
+# The series directory keeps its name inside it. Returns (staging dir, series dir).
+def make_stage_dir(scratch_dir, prefix):
+    stage_dir = tempfile.mkdtemp(prefix="unpack_to_bids-series-", dir=scratch_dir)
+    series_dir = os.path.join(stage_dir, prefix.split('/')[-1])
+    os.mkdir(series_dir)
+    return stage_dir, series_dir
+
+# Extract the members of one zip series into a new staging directory
+def stage_zip_series(source):
+    import zipfile
+    stage_dir, series_dir = make_stage_dir(source['scratch'], source['prefix'])
+    with zipfile.ZipFile(source['zip']) as zf:
+        for name, relpath in source['members']:
+            dst = os.path.join(series_dir, *relpath.split('/'))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with zf.open(name) as infile, open(dst, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+    return stage_dir, series_dir
+
+# Find the requested series in a (possibly compressed) tar archive. Tar archives
+# are read in a single streaming pass: the members of each requested series are
+# extracted into scratch_dir, and the series is yielded once the stream moves on
+# to another directory. convert_one_series removes each staging directory.
+def tar_series_sources(archive, series_numbers, scratch_dir):
+    import tarfile
+    staged = None
+    seen = set()
+    with tarfile.open(archive, 'r|*') as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            series, prefix, relpath = archive_member_series(member.name)
+            if series not in series_numbers:
+                continue
+            if staged is not None and staged['prefix'] != prefix:
+                yield staged['series'], staged
+                staged = None
+            if staged is None:
+                if series in seen:
+                    raise UnpackError("ERROR: The files of series " + str(series) + " are not stored together in " + archive + 
+                                      ", or more than one directory holds that series")
+                seen.add(series)
+                stage_dir, series_dir = make_stage_dir(scratch_dir, prefix)
+                staged = {'label': archive + ":" + prefix, 
+                          'series': series, 
+                          'prefix': prefix, 
+                          'dir': series_dir, 
+                          'files': [], 
+                          'stage_dir': stage_dir}
+            dst = os.path.join(staged['dir'], *relpath.split('/'))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            # Tar headers only keep whole-second times, so hash the contents on
+            # the way through to tell apart series with the same file names
+            digest = hashlib.sha1()
+            with tf.extractfile(member) as infile, open(dst, 'wb') as outfile:
+                for block in iter(lambda: infile.read(1 << 20), b''):
+                    digest.update(block)
+                    outfile.write(block)
+            staged['files'].append((relpath, member.size, digest.hexdigest()))
+    if staged is not None:
+        yield staged['series'], staged
+    not_found = sorted(set(series_numbers) - seen)
+    if len(not_found) > 0:
+        logger.warning("WARNING: No series directory found in " + archive + " for series: " + 
+              ", ".join(str(s) for s in not_found))
+
+# Convert one series into unpacked_dir, reusing cached outputs when the series
+# is unchanged. A series source is a dict with a 'label' for messages, the
+# 'dir' to convert (or a 'zip' archive to extract it from), its 'files' for
+# the cache key (None: list 'dir'), and the 'stage_dir' to remove when done,
+# if it was extracted from an archive. dcm2niix writes into a private temporary
+# directory so that the outputs of this series can be told apart from the others.
+# Returns the exit code, dcm2niix output, whether the cache was used, and the
+# paths of the series' outputs in unpacked_dir. With a report, the DICOM bytes
+# read and the output bytes written are recorded for the series.
+def convert_one_series(series, source, unpacked_dir, cache, report = None):
+    stage_dir = source.get('stage_dir')
+    with timed(report, 'conversion', 'series', str(series)) as entry:
+        try:
+            if report is not None and source['files'] is None:
+                source['files'] = dir_fingerprint(source['dir'])
+            key = None
+            if cache is not None:
+                key = series_cache_key(source, cache)
+                outputs = cache_restore(cache, key, unpacked_dir)
+                if outputs is not None:
+                    entry.update({'cached': True, 'files': len(outputs)})
+                    return 0, "", True, outputs
+            series_dir = source.get('dir')
+            if series_dir is None:
+                stage_dir, series_dir = stage_zip_series(source)
+            outputs = []
+            tmp_dir = tempfile.mkdtemp(prefix=".series-", dir=unpacked_dir)
+            try:
+                code, output = run_dcm2niix(series_dir, tmp_dir)
+                if code == 0:
+                    if cache is not None:
+                        cache_store(cache, key, tmp_dir)
+                    for f in os.listdir(tmp_dir):
+                        os.replace(os.path.join(tmp_dir, f), os.path.join(unpacked_dir, f))
+                        outputs.append(os.path.join(unpacked_dir, f))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            if report is not None:
+                entry.update({'cached': False, 
+                              'bytes_read': sum(size for relpath, size, stamp in source['files']), 
+                              'bytes_written': sum(os.path.getsize(f) for f in outputs), 
+                              'files': len(outputs)})
+            return code, output, False, outputs
+        finally:
+            if stage_dir is not None:
+                shutil.rmtree(stage_dir, ignore_errors=True)
+
+# Report the result of one conversion. Returns (series, inventory), or None if
+# dcm2niix failed, in which case the series is added to failed.
+def finish_conversion(series, source, result, failed):
+    code, output, cached, outputs = result
+    if code != 0:
+        logger.error("---- dcm2niix failed for series " + str(series) + 
+              " (exit code " + str(code) + "):\n" + output)
+        failed.append(series)
+        return None
+    elif cached:
+        logger.info("---- Reused cached conversion of series " + str(series) + ": " + source['label'])
+    else:
+        logger.info("---- Converted series " + str(series) + ": " + source['label'])
+    return series, index_unpacked_files(outputs)
+
+# Convert only the requested series, running one dcm2niix process per series
+# through a pool of at most `jobs` concurrent processes. input_dir is a
+# directory of series directories, or a zip/tar archive of one; archive members
+# are extracted one series at a time into scratch_dir (default: $TMPDIR). Pass a
+# cache (see the --cache_* options) to skip series that were converted before,
+# and a report to time each series (see timed).
+#
+# This is a generator: it yields (series, inventory) as soon as each series is
+# converted, where inventory indexes that series' outputs only.
+def convert_series(input_dir, unpacked_dir, series_numbers, jobs, cache = None, scratch_dir = None, report = None):
+    import concurrent.futures
+    import zipfile
+    import dicom_headers
+    if zipfile.is_zipfile(input_dir):
+        sources = zip_series_sources(input_dir, series_numbers, scratch_dir)
+    elif dicom_headers.is_archive(input_dir):
+        sources = tar_series_sources(input_dir, series_numbers, scratch_dir)
+    else:
+        series_dirs = find_series_dirs(input_dir, series_numbers)
+        if len(series_dirs) == 0:
+            logger.warning("WARNING: No series directories found in " + input_dir + 
+                  ". Converting the whole directory with a single dcm2niix call.")
+            with timed(report, 'conversion', 'series', 'all'):
+                code, output = run_dcm2niix(input_dir, unpacked_dir)
+            if code != 0:
+                raise UnpackError("ERROR: dcm2niix failed with exit code " + str(code) + ":\n" + output)
+            inventory = build_unpacked_inventory(unpacked_dir)
+            for series in sorted(series_numbers):
+                yield series, inventory
+            return
+        not_found = sorted(set(series_numbers) - set(series_dirs))
+        if len(not_found) > 0:
+            logger.warning("WARNING: No series directory found for series: " + ", ".join(str(s) for s in not_found))
+        sources = ((series, {'label': series_dirs[series], 'dir': series_dirs[series], 'files': None}) 
+                   for series in sorted(series_dirs))
+
+    failed = []
+    pending = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for series, source in sources:
+            pending[pool.submit(convert_one_series, series, source, unpacked_dir, cache, report)] = (series, source)
+            # Keep at most 2 * jobs series waiting, so archives are never
+            # extracted far ahead of dcm2niix
+            while len(pending) >= 2 * jobs:
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    series, source = pending.pop(future)
+                    item = finish_conversion(series, source, future.result(), failed)
+                    if item is not None:
+                        yield item
+        for future in concurrent.futures.as_completed(list(pending)):
+            series, source = pending.pop(future)
+            item = finish_conversion(series, source, future.result(), failed)
+            if item is not None:
+                yield item
+    if cache is not None:
+        cache_evict(cache)
+    if len(failed) > 0:
+        raise UnpackError("ERROR: dcm2niix failed for series: " + ", ".join(str(s) for s in sorted(failed)))
+
+# Convert the requested series and put each one into the BIDS tree as soon as
+# it is converted, so placement overlaps with conversion of the other series.
+# Converted series are handed to `jobs` placement threads, which call
+# place_series(series, inventory), through a queue holding at most `jobs`
+# series; conversion waits when placement falls behind. Series in reused
+# ({series: inventory}) were converted before (see --resume) and are only placed.
+def convert_and_place(input_dir, unpacked_dir, series_numbers, jobs, cache, place_series, scratch_dir = None, 
+                      reused = {}, report = None):
+    converted = queue.Queue(maxsize=jobs)
+    errors = []
+
+    def placement_worker():
+        while True:
+            item = converted.get()
+            if item is None:
+                return
+            if len(errors) > 0:
+                continue
+            try:
+                place_series(*item)
+            except BaseException as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=placement_worker) for i in range(jobs)]
+    for worker in workers:
+        worker.start()
+    try:
+        for item in sorted(reused.items()):
+            converted.put(item)
+        if len(series_numbers) > 0:
+            for item in convert_series(input_dir, unpacked_dir, series_numbers, jobs, cache, scratch_dir, report):
+                if len(errors) > 0:
+                    break
+                converted.put(item)
+    finally:
+        for worker in workers:
+            converted.put(None)
+        for worker in workers:
+            worker.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+# Clone src into dst with a copy-on-write reflink. Raises OSError if the
+# filesystem does not support it.
+def reflink(src, dst):
+    with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+        except OSError:
+            outfile.close()
+            os.remove(dst)
+            raise
+
+# Remove the output of a previous run written with the other NIfTI extension
+# (.nii vs .nii.gz), so the session never holds both
+def remove_stale(fpath):
+    if os.path.lexists(fpath):
+        logger.debug("-------- Removing " + os.path.basename(fpath) + " from a previous run")
+        os.remove(fpath)
+
+# Put a NIfTI file into the BIDS tree without copying its data when possible.
+# Falls back to a copy when the placement mode is not possible, e.g. when src
+# and dst are on different filesystems. Returns the placement mode used.
+def place_file(src, dst, placement):
+    # Never write through an existing hardlink or symlink left by a previous run
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if placement == 'hardlink':
+            os.link(src, dst)
+            return placement
+        elif placement == 'reflink':
+            reflink(src, dst)
+            return placement
+        elif placement == 'move':
+            os.rename(src, dst)
+            return placement
+        elif placement == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return placement
+    except OSError as e:
+        reason = "different filesystems" if e.errno == errno.EXDEV else e.strerror
+        logger.info("-------- Could not " + placement + " " + os.path.basename(src) + 
+              " (" + reason + "). Copying instead.")
+    if placement == 'move':
+        shutil.move(src, dst)
+    else:
+        shutil.copy(src, dst)
+    return 'copy'
+
+# Compress one block of data into a complete gzip member
+def gzip_block(block, level):
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+# Stream src into a gzip file at dst. Blocks are compressed in parallel on
+# block_pool as independent gzip members, whose concatenation is a valid .gz
+# file (read by gzip, zlib's gzread, nibabel, FSL and AFNI alike). Each block
+# read takes one of block_slots, a semaphore shared by all files compressed at
+# once, until it is written, which bounds the memory of the whole session.
+# When no slot is free, this file's finished blocks are written out first, so
+# files never wait on slots held by each other.
+def gzip_file(src, dst, level, block_pool, block_slots):
+    tmp = dst + ".part"
+    pending = collections.deque()
+
+    def write_next():
+        future = pending.popleft()
+        try:
+            outfile.write(future.result())
+        finally:
+            block_slots.release()
+
+    try:
+        with open(src, 'rb') as infile, open(tmp, 'wb') as outfile:
+            while True:
+                while not block_slots.acquire(blocking=len(pending) == 0):
+                    write_next()
+                block = infile.read(GZIP_BLOCK_SIZE)
+                if len(block) == 0:
+                    block_slots.release()
+                    break
+                pending.append(block_pool.submit(gzip_block, block, level))
+            while len(pending) > 0:
+                write_next()
+            if outfile.tell() == 0:
+                outfile.write(gzip_block(b'', level))
+        os.replace(tmp, dst)
+    finally:
+        while len(pending) > 0:
+            pending.popleft().cancel()
+            block_slots.release()
+
+# Compress a NIfTI file into the BIDS tree, removing the source when moving
+def compress_nifti(src, dst, level, block_pool, block_slots, placement):
+    gzip_file(src, dst, level, block_pool, block_slots)
+    if placement == 'move':
+        os.remove(src)
+
+# Copy scans from XNAT-Unpacked, to BIDS-compliant directory. Sidecars are
+# always written as new files, with their edits applied (see SIDECAR_EDITS). NIfTI files
+# are put into place according to place_opts, a dict with:
+#   placement:  one of PLACEMENT_MODES
+#   gzip_level: compress NIfTI files into .nii.gz at this level (None: no compression)
+#   block_pool, block_slots: thread pool for compression, and a semaphore bounding
+#               the blocks in flight for all files at once (see gzip_file)
+#   report:     optional run report that times each file (see timed)
+def copy_to_bids(runs, img_type, this_sess, inventory, fmap_apply = {}, place_opts = None):
+    if place_opts is None:
+        place_opts = {'placement': 'copy', 'gzip_level': None}
+    report = place_opts.get('report')
     for i in range(0,len(runs)):
-        run_number = runs[i][0]
+        series = series_number(runs[i][0])
         fname = runs[i][1]
     
         # Create img_type folder if it doesn't exist
         if not os.path.exists(os.path.join(this_sess, img_type)):
-            print("Creating directory for " + img_type + " data.")
-            os.mkdir(os.path.join(this_sess, img_type))
+            logger.debug("Creating directory for " + img_type + " data.")
+            os.makedirs(os.path.join(this_sess, img_type), exist_ok=True)
     
-        # Move files ending with run_number.nii and run_number.json into the BIDS dir
-        if len(os.listdir(os.path.join(input_dir, "UNPACKED"))) <= 1:
-            print("No files found in input directory: " + os.path.join(input_dir, "UNPACKED"))
-        for f in os.listdir(os.path.join(input_dir, "UNPACKED")):
-            if f.endswith("_" + run_number + ".nii"):
-                print("---- " + fname + ".nii")
-                shutil.copy(os.path.join(input_dir, "UNPACKED", f), 
-                            os.path.join(this_sess, img_type, fname + ".nii"))
-            elif f.endswith("_" + run_number + ".json"):
-                print("---- " + fname + ".json")
-                shutil.copy(os.path.join(input_dir, "UNPACKED", f), 
-                            os.path.join(this_sess, img_type, fname + ".json"))
-                if img_type == 'func':
-                    fpath = os.path.join(this_sess, img_type, fname + ".json")
-                    update_task(fpath, fname)
-                if img_type == 'fmap':
-                    print("-------- Updating IntendedFor Field in .json file")
-                    fpath = os.path.join(this_sess, img_type, fname + ".json")
-                    update_intended_for(fpath, fname, fmap_apply)
-            elif f.endswith("_" + run_number + ".bval"):
-                print("---- " + fname + ".bval")
-                shutil.copy(os.path.join(input_dir, "UNPACKED", f), 
-                            os.path.join(this_sess, img_type, fname + ".bval"))
-            elif f.endswith("_" + run_number + ".bvec"):
-                print("---- " + fname + ".bvec")
-                shutil.copy(os.path.join(input_dir, "UNPACKED", f), 
-                            os.path.join(this_sess, img_type, fname + ".bvec"))
-
-def update_intended_for(fpath, fname, fmap_apply):
-    intended_for = []
-    for i in range(0,len(fmap_apply)):
-        if fname == fmap_apply[i][0]:
-            intended_for = fmap_apply[i][1:]
-            with open(fpath, 'r+') as outfile:
-                data = json.load(outfile)
-                data['IntendedFor'] = intended_for
-                outfile.seek(0)
-                json.dump(data, outfile, indent=4)
-                outfile.close()
-
-def update_task(fpath, fname):
+        # Copy the series' .nii, .json, .bval and .bvec files into the BIDS dir
+        for ext in UNPACKED_EXTS:
+            for f in inventory.get((series, ext), []):
+                fpath = os.path.join(this_sess, img_type, fname + ext)
+                size = os.path.getsize(f)
+                if ext == ".nii" and place_opts['gzip_level'] is not None:
+                    logger.debug("---- " + img_type + "/" + fname + ext + ".gz")
+                    with timed(report, 'placement', 'files', img_type + "/" + fname + ext + ".gz") as entry:
+                        remove_stale(fpath)
+                        compress_nifti(f, fpath + ".gz", place_opts['gzip_level'], place_opts['block_pool'], 
+                                       place_opts['block_slots'], place_opts['placement'])
+                        entry.update({'method': 'gzip', 'bytes_read': size, 
+                                      'bytes_written': os.path.getsize(fpath + ".gz"), 'files': 1})
+                    continue
+                logger.debug("---- " + img_type + "/" + fname + ext)
+                stage = 'sidecars' if ext == ".json" else 'placement'
+                with timed(report, stage, 'files', img_type + "/" + fname + ext) as entry:
+                    if ext == ".nii":
+                        remove_stale(fpath + ".gz")
+                        method = place_file(f, fpath, place_opts['placement'])
+                    elif ext == ".json":
+                        rewrite_sidecar(f, fpath, img_type, fname, fmap_apply)
+                        method = 'rewrite'
+                    else:
+                        shutil.copy(f, fpath)
+                        method = 'copy'
+                    entry.update({'method': method, 'files': 1})
+                    # Links, renames and reflinks do not copy any file data
+                    if method in ['copy', 'rewrite']:
+                        entry.update({'bytes_read': size, 'bytes_written': os.path.getsize(fpath)})
+
+# Return the name of a NIfTI file with the other extension (.nii vs .nii.gz),
+# or None for other files
+def other_nifti_ext(fpath):
+    if fpath.endswith(".nii.gz"):
+        return fpath[:-len(".gz")]
+    if fpath.endswith(".nii"):
+        return fpath + ".gz"
+    return None
+
+# Hardlink the files of an existing session that a new run did not write (e.g.
+# runs converted by an earlier call) into the new session tree, so that
+# committing the new tree keeps them. Outputs of a previous run written with the
+# other NIfTI extension are left out.
+def carry_over(old_sess, new_sess):
+    for root, dirs, files in os.walk(old_sess):
+        dst_root = os.path.join(new_sess, os.path.relpath(root, old_sess))
+        for f in files:
+            src = os.path.join(root, f)
+            dst = os.path.join(dst_root, f)
+            other = other_nifti_ext(dst)
+            if os.path.lexists(dst) or (other is not None and os.path.lexists(other)):
+                continue
+            os.makedirs(dst_root, exist_ok=True)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                link_or_copy(src, dst)
+
+# Swap two paths in one step with renameat2(RENAME_EXCHANGE) (Linux 3.15+,
+# glibc 2.28+). Raises OSError where it is not supported, e.g. on NFS.
+def exchange_paths(path1, path2):
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, 'renameat2'):
+        raise OSError(errno.ENOSYS, "renameat2 is not available")
+    if libc.renameat2(AT_FDCWD, os.fsencode(path1), AT_FDCWD, os.fsencode(path2), RENAME_EXCHANGE) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path1)
+
+# Clean up after a run that was killed while committing the session at
+# sess_path (see commit_session). A session that was moved aside but not yet
+# replaced is moved back; other leftover trees are removed.
+def restore_session(sess_path):
+    parent, name = os.path.split(sess_path)
+    if not os.path.isdir(parent):
+        return
+    leftovers = [os.path.join(parent, d) for d in os.listdir(parent) 
+                 if d.startswith("." + name + ".old-") or d.startswith("." + name + ".partial-")]
+    old = sorted((d for d in leftovers if ".old-" in os.path.basename(d)), key=os.path.getmtime)
+    if not os.path.exists(sess_path) and len(old) > 0:
+        logger.warning("WARNING: Restoring " + sess_path + ", left aside by an interrupted run")
+        os.rename(old[-1], sess_path)
+        leftovers.remove(old[-1])
+    for d in leftovers:
+        shutil.rmtree(d, ignore_errors=True)
+
+# Commit a session staged in scratch into the BIDS tree at sess_path, creating
+# the subject directory if needed. The staged tree is renamed into place when
+# scratch and the output directory share a filesystem, or else copied next to
+# sess_path first, so that readers of the dataset never see a half-written
+# session. An existing session is swapped with the new tree in one step once its
+# other files have been carried over; where that is not supported, it is moved
+# aside first (and moved back by restore_session if the run is killed then).
+# finalize, if given, is called with the complete new tree just before it is
+# moved into place. Returns whether the staged tree had to be copied.
+def commit_session(staged_sess, sess_path, finalize = None):
+    parent, name = os.path.split(sess_path)
+    partial = os.path.join(parent, "." + name + ".partial-" + str(os.getpid()))
+    old = os.path.join(parent, "." + name + ".old-" + str(os.getpid()))
+    copied = False
+    if not os.path.exists(parent):
+        logger.info("Creating subject directory: " + parent)
+        os.makedirs(parent, exist_ok=True)
+    try:
+        os.rename(staged_sess, partial)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        logger.info("----Copying session from scratch into " + parent)
+        shutil.copytree(staged_sess, partial, symlinks=True)
+        copied = True
+    try:
+        if os.path.exists(sess_path):
+            carry_over(sess_path, partial)
+        if finalize is not None:
+            finalize(partial)
+        if os.path.exists(sess_path):
+            try:
+                # partial holds the old session afterwards, and is removed below
+                exchange_paths(partial, sess_path)
+            except OSError:
+                os.rename(sess_path, old)
+                try:
+                    os.rename(partial, sess_path)
+                except OSError:
+                    os.rename(old, sess_path)
+                    raise
+                shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(partial, sess_path)
+    finally:
+        shutil.rmtree(partial, ignore_errors=True)
+    return copied
+
+# Build the run registry: every requested run by series number, with its run
+# number as given, datatype, BIDS filename and path relative to the subject
+# directory (as used in IntendedFor). Exits if a series is requested twice or
+# two runs would be written to the same file.
+def build_run_registry(runs_by_type, sess, nii_ext):
+    registry = {}
+    paths = {}
+    for img_type, runs in runs_by_type:
+        for run_number, fname in runs:
+            series = series_number(run_number)
+            path = 'ses-' + str(sess) + '/' + img_type + '/' + fname + nii_ext
+            if series in registry:
+                other = registry[series]
+                raise UnpackError("ERROR: Run " + run_number + " is requested more than once: as " + 
+                                  other['datatype'] + "/" + other['fname'] + " and as " + img_type + "/" + fname)
+            if path in paths:
+                raise UnpackError("ERROR: Runs " + paths[path] + " and " + run_number + " would both be written to " + path)
+            registry[series] = {'run_number': run_number, 'datatype': img_type, 'fname': fname, 'path': path}
+            paths[path] = run_number
+    return registry
+
+# Resolve --intended_for groups (a fieldmap run, then the runs it applies to)
+# into {FMAP_FILENAME: [PATH, ...]} for set_intended_for. Fieldmaps without a
+# group apply to all functional runs. Exits on runs that were not requested,
+# groups that do not start with a fieldmap, and fieldmaps with several groups.
+def resolve_intended_for(registry, fmap_apply):
+    fmap_apply_names = {}
+    for group in fmap_apply:
+        fmap = registry.get(group[0])
+        if fmap is None or fmap['datatype'] != 'fmap':
+            raise UnpackError("ERROR: --intended_for " + " ".join(str(run) for run in group) + ": run " + str(group[0]) + 
+                              " is not one of the requested fieldmaps (--fmap)")
+        if fmap['fname'] in fmap_apply_names:
+            raise UnpackError("ERROR: More than one --intended_for flag for fieldmap run " + str(group[0]))
+        paths = []
+        for run in group[1:]:
+            target = registry.get(run)
+            if target is None:
+                raise UnpackError("ERROR: --intended_for " + " ".join(str(run) for run in group) + ": run " + str(run) + 
+                                  " is not one of the requested runs")
+            if target['datatype'] == 'fmap':
+                raise UnpackError("ERROR: --intended_for " + " ".join(str(run) for run in group) + ": run " + str(run) + 
+                                  " is a fieldmap")
+            paths.append(target['path'])
+        # Drop runs listed twice, keeping the order given
+        fmap_apply_names[fmap['fname']] = list(dict.fromkeys(paths))
+
+    defaults = [run['fname'] for run in registry.values() 
+                if run['datatype'] == 'fmap' and run['fname'] not in fmap_apply_names]
+    if len(defaults) > 0:
+        logger.warning("WARNING: --intended_for flag not specified for all fieldmaps." + 
+              " Unspecified fieldmaps will be IntendedFor ALL functional runs")
+        func_paths = [run['path'] for run in registry.values() if run['datatype'] == 'func']
+        for fname in defaults:
+            fmap_apply_names[fname] = func_paths
+    return fmap_apply_names
+
+# Put all runs of one converted series into the BIDS tree. runs_by_series maps
+# a series number to a list of (img_type, [RUN_NUM, FILENAME]) pairs.
+# Pass a journal to record the series' dcm2niix outputs, placed files and
+# rewritten sidecars for --resume.
+def place_series(series, inventory, unpacked_dir, runs_by_series, this_sess, fmap_apply, place_opts, journal = None):
+    runs = runs_by_series[series]
+    if journal is not None:
+        outputs = [f for (output_series, ext), paths in inventory.items() if output_series == series for f in paths]
+        journal_files(journal, series, 'converted', unpacked_dir, [os.path.basename(f) for f in outputs], 
+                      place_opts.get('report'))
+    check_inventory(inventory, unpacked_dir, [(img_type, [run]) for img_type, run in runs])
+    for img_type, run in runs:
+        copy_to_bids([run], img_type, this_sess, inventory, fmap_apply, place_opts)
+    if journal is not None:
+        placed = []
+        sidecars = []
+        for img_type, run in runs:
+            for ext in UNPACKED_EXTS:
+                if len(inventory.get((series, ext), [])) == 0:
+                    continue
+                relpath = os.path.join(img_type, run[1] + ext)
+                if ext == ".json":
+                    sidecars.append(relpath)
+                elif ext == ".nii" and place_opts['gzip_level'] is not None:
+                    placed.append(relpath + ".gz")
+                else:
+                    placed.append(relpath)
+        journal_files(journal, series, 'placed', this_sess, placed, place_opts.get('report'))
+        journal_files(journal, series, 'sidecars', this_sess, sidecars, place_opts.get('report'))
+
+# Sidecar edits. Each one updates the parsed dcm2niix JSON (data) in memory for
+# the BIDS file fname, before the sidecar is written into the BIDS tree.
+def set_intended_for(data, fname, fmap_apply):
+    if fname in fmap_apply:
+        logger.debug("-------- Updating IntendedFor Field in .json file")
+        data['IntendedFor'] = fmap_apply[fname]
+
+def set_task_name(data, fname, fmap_apply):
     tags = fname.split("_")
     tags = ["modality-" + tag if "-" not in tag else tag for tag in tags]
     tags = dict(s.split("-") for s in tags)
-    print("-------- Updating TaskName Field in .json file")
-    with open(fpath, 'r+') as outfile:
-        data = json.load(outfile)
-        data['TaskName'] = tags['task']
-        outfile.seek(0)
-        json.dump(data, outfile, indent=4)
-        outfile.close()
-
-def fname_error(fname, message):
-    sys.exit("ERROR: Bad filename: " + fname + "\n" + message)
-
-# Check if a tag exists. Throw an error if it exists but isn't alphanumeric
-def check_tag_alnum(fname, tags, tag, tag_type):
-    if tag in tags:
-        if not tags[tag].isalnum():
-            fname_error(fname, tag_type + " tag " + tags[tag] + " contains non-alphanumeric characters")
-        return True
-    else:
+    logger.debug("-------- Updating TaskName Field in .json file")
+    data['TaskName'] = tags['task']
+
+# Sidecar edits applied to each type of image. Add new metadata fixes here.
+SIDECAR_EDITS = {'func': [set_task_name], 
+                 'fmap': [set_intended_for]}
+
+# Read a dcm2niix sidecar once, apply every edit for img_type in memory, and
+# write the result once to dst. Sidecars without edits are written unchanged.
+def rewrite_sidecar(src, dst, img_type, fname, fmap_apply):
+    with open(src) as infile:
+        text = infile.read()
+    edits = SIDECAR_EDITS.get(img_type, [])
+    if len(edits) > 0:
+        data = json.loads(text)
+        for edit in edits:
+            edit(data, fname, fmap_apply)
+        text = json.dumps(data, indent=4)
+    dataset_metadata.write_atomic(dst, text)
+
+# Check user-specified filenames against the BIDS entity grammar (see
+# bids_validate.py). Every problem is reported before raising UnpackError.
+def check_filenames(runs_by_type, nii_ext):
+    num_errors = 0
+    for img_type, runs in runs_by_type:
+        for run in runs:
+            errors, warnings = bids_validate.validate_filename(run[1] + nii_ext, img_type)
+            for message in warnings:
+                logger.warning("WARNING: Potentially bad filename: " + run[1] + "\n----" + message)
+            for message in errors:
+                logger.error("ERROR: Bad filename: " + run[1] + "\n----" + message)
+            num_errors += len(errors)
+    if num_errors > 0:
+        raise UnpackError("ERROR: Found " + str(num_errors) + " problem(s) with the filenames above")
+
+# A journal records the completed stages of one session in
+# output_dir/.unpack_to_bids/journal/NAME.json, so that --resume can skip them
+# after an interrupted run:
+#   dataset_files: the --change entry logged for CHANGES (see update_dataset_files)
+#   series:        per series, the dcm2niix outputs in scratch ('converted'), and
+#                  the files placed ('placed') and sidecars rewritten ('sidecars')
+#                  in the staged session
+#   committed:     the files of the session moved into the BIDS tree
+# Each file is recorded with its size, modification time and inode, which only
+# takes a stat; a file that differs in any of them is redone.
+# The signature identifies the requested runs and output options; a journal
+# written for different ones only keeps its dataset_files stage, and is not
+# 'matched', so the session cannot be resumed from it.
+def load_journal(output_dir, name, signature):
+    fpath = os.path.join(output_dir, JOURNAL_DIR, name + ".json")
+    try:
+        with open(fpath) as infile:
+            data = json.load(infile)
+    except (OSError, ValueError):
+        data = {}
+    matched = data.get('signature') == signature
+    if not matched:
+        data = {'dataset_files': data.get('dataset_files')}
+    data['signature'] = signature
+    data.setdefault('series', {})
+    return {'path': fpath, 'data': data, 'lock': threading.Lock(), 'matched': matched}
+
+def save_journal(journal, stats = None):
+    os.makedirs(os.path.dirname(journal['path']), exist_ok=True)
+    dataset_metadata.write_atomic(journal['path'], json.dumps(journal['data'], indent=1, sort_keys=True), stats)
+
+# Set a top-level journal stage (e.g. dataset_files) and save the journal
+def journal_stage(journal, stage, value):
+    with journal['lock']:
+        journal['data'][stage] = value
+        save_journal(journal)
+
+def file_record(fpath):
+    st = os.stat(fpath)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ino': st.st_ino}
+
+# Record the files (paths relative to root) of one stage of a series and save
+# the journal, timed as the journal stage of report
+def journal_files(journal, series, stage, root, relpaths, report = None):
+    with timed(report, 'journal') as entry:
+        records = dict((relpath, file_record(os.path.join(root, relpath))) for relpath in relpaths)
+        with journal['lock']:
+            journal['data']['series'].setdefault(str(series), {})[stage] = records
+            save_journal(journal, entry)
+
+# Remove the files of a staged session that are not in keep (paths relative to
+# staged_sess), e.g. partial or temporary files left by a killed run
+def prune_staged(staged_sess, keep):
+    for root, dirs, files in os.walk(staged_sess):
+        for f in files:
+            fpath = os.path.join(root, f)
+            if os.path.relpath(fpath, staged_sess) not in keep:
+                logger.debug("-------- Removing " + os.path.relpath(fpath, staged_sess) + " left by an earlier run")
+                os.remove(fpath)
+
+# Return True if every recorded file under root is unchanged
+def verify_files(root, records):
+    if records is None:
         return False
+    for relpath, record in records.items():
+        try:
+            if file_record(os.path.join(root, relpath)) != record:
+                return False
+        except OSError:
+            return False
+    return True
+
+# Start the run report of a session (see --report). For each stage, the report
+# totals the wall time, bytes of file data read and written and number of files;
+# conversion also has an entry per series, and placement and sidecars one per file.
+def new_report(**info):
+    report = dict(info)
+    report.update({'stages': {}, 'series': {}, 'files': {}})
+    return report
+
+# Time one stage of a session into report (None: not reported). The caller
+# fills in the bytes and files of the yielded entry, and any other details;
+# the entry is also kept as report[section][key] when a section is given.
+# Stages run by several threads at once add up to more than the wall time.
+@contextlib.contextmanager
+def timed(report, stage, section = None, key = None):
+    entry = dict((field, 0) for field in REPORT_FIELDS)
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry['seconds'] = round(time.perf_counter() - start, 6)
+        if report is not None:
+            with REPORT_LOCK:
+                totals = report['stages'].setdefault(stage, dict((field, 0) for field in ['count'] + REPORT_FIELDS))
+                totals['count'] += 1
+                for field in REPORT_FIELDS:
+                    totals[field] += entry[field]
+                if section is not None:
+                    report[section][key] = dict(entry, stage=stage)
+
+def write_report(report, fpath):
+    for totals in report['stages'].values():
+        totals['seconds'] = round(totals['seconds'], 6)
+    dataset_metadata.write_atomic(fpath, json.dumps(report, indent=4, sort_keys=True) + "\n")
+
+# Lock the scratch directory of a session, so that a second run of the same
+# session into the same output directory stops instead of removing files in
+# use. The lock file is kept next to the directory, which is removed and
+# recreated. Closing the returned file releases the lock.
+def lock_scratch(scratch_dir):
+    os.makedirs(os.path.dirname(scratch_dir), exist_ok=True)
+    lockfile = open(scratch_dir + ".lock", 'a')
+    try:
+        fcntl.lockf(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lockfile.close()
+        raise UnpackError("ERROR: Another run is converting this session into the same output directory " + 
+                          "(scratch directory " + scratch_dir + " is locked)")
+    return lockfile
+
+# Return the options of convert_session as a namespace: the command-line
+# defaults, updated with options given by their long name (e.g. gzip=True)
+def session_options(**options):
+    args = build_parser().parse_args([])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError("Unknown unpack_to_bids option: " + name)
+        setattr(args, name, value)
+    return args
+
+# Create or update the dataset-level files in output_dir and log a change, as
+# with --dataset_files_only (e.g. once before a batch of sessions).
+# changes is a list of [VERSION, DESCRIPTION] pairs; the last one is logged.
+def write_dataset_files(output_dir, proj_name = "A neuroimaging project", changes = None, resume = False, 
+                        render_changes = False):
+    if changes is None:
+        changes = session_options().change
+    if not os.path.exists(output_dir):
+        logger.info("Creating Output directory at: " + output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+    update_dataset_files(output_dir, proj_name, changes, load_journal(output_dir, 'dataset', None), resume)
+    if render_changes:
+        dataset_metadata.render_changes(output_dir)
+
+# Convert the DICOM series of one session in input_dir into the BIDS dataset in
+# output_dir. Any command-line option can be given by its long name, e.g.
+#   convert_session('2001', '1', '/path/scans', '/path/bids',
+#                   anat=[['8', 'sub-2001_ses-1_T1w']], func=[['18', 'sub-2001_ses-1_task-rest_bold']],
+#                   intended_for=[[11, 18]], gzip=True, jobs=4)
+# Returns a dict with the BIDS subject label (sub), session (sess), the session
+# directory (session_dir), the registered runs (runs, see build_run_registry),
+# the files written into the session (files, relative to session_dir), whether
+# an earlier run had already completed the session (skipped), and the number of
+# validation errors with validate=True (validation_errors, otherwise None), and
+# the run report (report, see new_report), also written to report=PATH if given.
+# Problems with the options or the conversion raise UnpackError, whose message
+# is what the command line prints before exiting.
+def convert_session(sub, sess, input_dir, output_dir, **options):
+    args = session_options(sub=sub, sess=sess, input_dir=input_dir, output_dir=output_dir, **options)
+    check_args(args)
+
+    report = new_report(sub=args.sub, sess=args.sess, input_dir=args.input_dir, output_dir=args.output_dir, 
+                        started=time.strftime("%Y-%m-%dT%H:%M:%S%z"), 
+                        options=dict((name, getattr(args, name)) for name in 
+                                     ['jobs', 'placement', 'gzip', 'gzip_level', 'no_cache', 'scratch', 'resume']), 
+                        status='failed', error=None)
+    # cProfile only sees this thread; dcm2niix processes and the conversion and
+    # placement threads show up as the time spent waiting for them
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        result = session_stages(args, report)
+        report['status'] = 'skipped' if result['skipped'] else 'ok'
+    except UnpackError as e:
+        report['error'] = str(e)
+        raise
+    except BaseException as e:
+        report['error'] = repr(e)
+        raise
+    finally:
+        report['seconds'] = round(time.perf_counter() - start, 6)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info("Wrote profile to " + args.profile)
+        if args.report is not None:
+            write_report(report, args.report)
+            logger.info("Wrote run report to " + args.report)
+    result['report'] = report
+    return result
+
+# Run the stages of convert_session with checked options, timing them into report
+def session_stages(args, report):
+    # Resolve the options into the runs to convert, and check their names
+    with timed(report, 'arguments') as entry:
+        # Assign input arguments to more convenient variable names
+        sub = args.sub
+        bids_sub = re.sub('[^0-9a-zA-Z]+', '', sub) #Create a BIDS-compliant sub name, in case subject name contains non-alphanum chars
+        if bids_sub != sub:
+            logger.warning("WARNING: " + sub + ", the subject name you provided, is not BIDS compliant. Using " + bids_sub + " instead.")
+        sess = args.sess
+        proj_name = args.proj_name
+        input_dir = args.input_dir
+        output_dir = args.output_dir
+        anat_runs = list(args.anat)
+        dwi_runs = list(args.dwi)
+        fmap_runs = list(args.fmap)
+        func_runs = list(args.func)
+        changes = args.change
+        fmap_apply = args.intended_for
+
+        # ======================================================================
+        # Map series to BIDS filenames with the --rules file
+        # ======================================================================
+        # Run numbers given with --anat/--func/--dwi/--fmap take precedence over the rules
+        if args.rules is not None:
+            import dicom_headers
+            logger.info("Reading DICOM headers in " + input_dir)
+            dicom_inventory = dicom_headers.scan_session(input_dir)
+            rule_runs, names = dicom_headers.apply_rules(dicom_inventory, load_rules(args.rules), 
+                                                         bids_sub, sess)
+            given = set(series_number(run[0]) for run in anat_runs + func_runs + dwi_runs + fmap_runs)
+            logger.info("Series mapped by the rules in " + args.rules + ":")
+            for img_type, runs in [("anat", anat_runs), ("func", func_runs), ("dwi", dwi_runs), ("fmap", fmap_runs)]:
+                for run in rule_runs[img_type]:
+                    if series_number(run[0]) not in given:
+                        logger.debug("---- " + img_type + " " + run[0] + " " + run[1])
+                        runs.append(run)
+
+        # ======================================================================
+        # Register every requested run and parse the -intended_for argument
+        # ======================================================================
+        nii_ext = ".nii.gz" if args.gzip else ".nii"
+        runs_by_type = [("anat", anat_runs), ("fmap", fmap_runs), ("func", func_runs), ("dwi", dwi_runs)]
+        run_registry = build_run_registry(runs_by_type, sess, nii_ext)
+
+        # Convert IntendedFor from run numbers to filenames. Fieldmaps without an
+        # --intended_for flag apply to all functional runs, by default.
+        fmap_apply_names = resolve_intended_for(run_registry, fmap_apply)
 
-# Check if a tag exists. Throw an error if it exists but isn't entirely numeric
-def check_tag_digits(fname, tags, tag, tag_type):
-    if tag in tags:
-        if not tags[tag].isdigit():
-            fname_error(fname, tag_type + " tag " + tags[tag] + " must only contain digits")
-        return True
+        # ======================================================================
+        # Lightweight checks that filenames are generally BIDS-compliant
+        # ======================================================================
+        # Check a few things
+        if not sub.isalnum():
+            logger.info('Creating BIDS-compliant subject name...\n----Original: ' + sub + '\n----Final: ' + bids_sub)
+
+        check_filenames(runs_by_type, nii_ext)
+        entry['files'] = len(run_registry)
+
+    # ==========================================================================
+    # Create first level directories and metadata files
+    # ==========================================================================
+    # Create NIFTI (output) directory
+    if not os.path.exists(output_dir):
+        logger.info("Creating Output directory at: " + output_dir)
+        os.makedirs(output_dir, exist_ok=True)
     else:
-        return False
+        logger.info("Output directory exists. Using: " + output_dir)
 
-# Check if the file tail (modality tag) is BIDS-valid
-def check_ftail(fname, tags, img_type):
-    ex_modalities = {'anat':'T1w', 'func':'bold', 'dwi':'dwi', 'fmap':'phasediff or magnitude'}
-    anat_modes = ['T1w', 'T2w', 'T1rho', 'T1map', 'T2map', 'T2star', 'FLAIR', 'FLASH', 'PD', 
-                  'PDT2', 'inplaneT1', 'inplaneT2', 'angio', 'defacemask', 'SWImagandphase']
-    func_modes = ['bold', 'sbref']
-    dwi_modes = ['dwi']
-    fmap_modes = ['phasediff', 'magnitude', 'phase1', 'phase2', 'magnitude1', 'magnitude2', 'fieldmap', 'epi']
-
-    if 'modality' not in tags:
-        fname_error(fname, "Could not find modality tag at the end of the filename. For example, a " + 
-                            img_type + " image would include '" + ex_modalities[img_type] + "' at the end of the filename.")
-    elif not tags['modality'].isalnum():
-        fname_error(fname, "Modality tag '" + tags['modality'] + "' contains non-alphanumeric characters")
-    
-    if img_type=="anat":
-        if tags['modality'] not in anat_modes:
-            fname_error(fname, tags['modality'] + " not supported for anat images. Choose from: " + str(anat_modes))
-    elif img_type=="func":
-        if tags['modality'] not in func_modes:
-            fname_error(fname, tags['modality'] + " not supported for func images. Choose from: " + str(func_modes))
-    elif img_type=="dwi":
-        if tags['modality'] not in dwi_modes:
-            fname_error(fname, tags['modality'] + " not supported for dwi images. Choose from: " + str(dwi_modes))
-    elif img_type=="fmap":
-        if tags['modality'] not in fmap_modes:
-            print("WARNING: " + "Potentially bad filename: " + fname + "\n" +
-                  tags['modality'] + " might not be a good tag for a fieldmap. Suggested tags: " +
-                  str(fmap_modes))
-            
-# Check if a user-specified filename is BIDS compatible
-def check_filename(fname, img_type):
-    tags = fname.split("_")
-    tags = ["modality-" + tag if "-" not in tag else tag for tag in tags]
-    tags = dict(s.split("-") for s in tags)
-    
-    # Check sub tag (MANDATORY)
-    if not check_tag_alnum(fname, tags, 'sub', 'Subject'):  
-        fname_error(fname, "Filename should start with 'sub-PARTICIPANT' tag")  
-
-    # Check ses tag (OPTIONAL)
-    check_tag_alnum(fname, tags, 'ses', 'Session')
-
-    # Check file tail (modality tag and filetype)
-    check_ftail(fname, tags, img_type)
-
-    # Check ANAT images:
-    if img_type == "anat":
-        check_tag_alnum(fname, tags, 'acq', 'Acquisition')
-        check_tag_alnum(fname, tags, 'ce', 'Contrast Enhancement')
-        check_tag_alnum(fname, tags, 'rec', 'Reconstruction')
-        check_tag_alnum(fname, tags, 'mod', 'Modalities Ref')
-        check_tag_digits(fname, tags, 'run', 'Run')
-    # Check FUNC images:
-    elif img_type == "func":
-        if not check_tag_alnum(fname, tags, 'task', 'Task'):
-            fname_error(fname, "Functional filename must contain 'task-DESCRIPTION' tag")
-        check_tag_alnum(fname, tags, 'rec', 'Reconstruction')
-        check_tag_digits(fname, tags, 'run', 'Run')
-        check_tag_digits(fname, tags, 'echo', 'Echo')
-    # Check DWI images:
-    elif img_type == "dwi":
-        check_tag_alnum(fname, tags, 'acq', 'Acquisition')
-        check_tag_digits(fname, tags, 'run', 'Run')
-    # Check FIELDMAP images:
-    elif img_type == "fmap":
-        check_tag_alnum(fname, tags, 'acq', 'Acquisition')
-        check_tag_digits(fname, tags, 'run', 'Run')
-        check_tag_alnum(fname, tags, 'dir', 'DIR')
+    # The journal of this session records each completed stage, for --resume
+    journal = load_journal(output_dir, 'sub-' + bids_sub + '_ses-' + sess, 
+                           hashlib.sha256(json.dumps([input_dir, runs_by_type, fmap_apply_names, 
+                                                      args.gzip_level if args.gzip else None]).encode()).hexdigest())
+    # A journal written for other runs or options (e.g. a renamed run) cannot be
+    # resumed from, so the session starts over as without --resume
+    resume = args.resume and journal['matched']
+    if args.resume and not resume:
+        logger.info("No journal of an earlier run with the same runs and options. Starting the session over.")
+    if not resume:
+        journal['data']['series'] = {}
+        journal['data'].pop('committed', None)
+
+    # Create or update dataset_description.json, README, CHANGES and code directory.
+    # Batch runs (see unpack_to_bids_batch.py) write these once for all sessions.
+    if not args.skip_dataset_files:
+        with timed(report, 'dataset_metadata') as entry:
+            update_dataset_files(output_dir, proj_name, changes, journal, args.resume, entry)
+
+    # The session is only put into the subject directory by commit_session, so a
+    # failed run leaves the BIDS tree as it was
+    sess_path = os.path.join(output_dir, 'sub-' + bids_sub, 'ses-' + sess)
+
+    # Make a session directory in scratch. It is moved into the subject directory
+    # once all runs are in place. With --resume, the scratch directory of an
+    # interrupted run on this node is reused. The name is unique to the output
+    # directory, and a lock keeps two runs of one session from sharing it.
+    scratch_dir = os.path.join(args.scratch or tempfile.gettempdir(), 
+                               "unpack_to_bids-" + hashlib.sha256(os.path.abspath(output_dir).encode()).hexdigest()[:12] + 
+                               "-sub-" + bids_sub + "_ses-" + sess)
+    scratch_lock = lock_scratch(scratch_dir)
+    completed = False
+    try:
+        restore_session(sess_path)
+        session_done = False
+        if resume:
+            with timed(report, 'resume'):
+                session_done = verify_files(sess_path, journal['data'].get('committed'))
+        if session_done:
+            logger.info("Session was already completed by an earlier run. Skipping: " + sess_path)
+            files = sorted(journal['data']['committed'])
+            completed = True
+        else:
+            if not os.path.exists(sess_path):
+                logger.info("Creating new session directory: " + sess_path)
+            else:
+                logger.info("Putting data in existing session directory: " + sess_path)
+
+            # ==================================================================
+            # Convert DCM to NII & JSON using dcm2niix, and copy individual scans into
+            # relevant locations, in BIDS format
+            # ==================================================================
+            # Each series is put into the staged session as soon as dcm2niix finishes it,
+            # while the remaining series are still being converted. Converted images stay
+            # in scratch too, unless symlinks into INPUT_DIR/UNPACKED were requested.
+            if not resume:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+            staged_sess = os.path.join(scratch_dir, 'ses-' + sess)
+            os.makedirs(staged_sess, exist_ok=True)
+            logger.info("----Assembling session in scratch directory: " + scratch_dir)
+
+            # Make the anat, fmap, func and dwi directories that will be used
+            for img_type, runs in runs_by_type:
+                if len(runs) > 0 and not os.path.exists(os.path.join(staged_sess, img_type)):
+                    logger.debug("Creating directory for " + img_type + " data.")
+                    os.mkdir(os.path.join(staged_sess, img_type))
+
+            logger.info("Converting DICOMS to NII and copying them into " + sess_path)
+            if args.placement == 'symlink':
+                unpacked_dir = os.path.join(input_dir, "UNPACKED")
+            else:
+                unpacked_dir = os.path.join(scratch_dir, "UNPACKED")
+            if not os.path.exists(unpacked_dir):
+                logger.debug("----Creating Directory for unpacked Images: " + unpacked_dir)
+                os.mkdir(unpacked_dir)
+            runs_by_series = dict((series, [(run['datatype'], [run['run_number'], run['fname']])]) 
+                                  for series, run in run_registry.items())
+            cache = None
+            if not args.no_cache:
+                cache = {'dir': args.cache_dir, 
+                         'max_bytes': int(args.cache_size * 1024**3), 
+                         'hash': args.cache_hash, 
+                         'version': dcm2niix_version()}
+
+            # With --resume, skip series that an interrupted run already placed, and only
+            # place those it already converted. Any other file in the staged session is
+            # removed, so that only files recorded in the journal are committed.
+            to_convert = set(runs_by_series)
+            reused = {}
+            if resume:
+                with timed(report, 'resume'):
+                    kept = set()
+                    for series in sorted(runs_by_series):
+                        state = journal['data']['series'].get(str(series), {})
+                        if verify_files(staged_sess, state.get('placed')) and verify_files(staged_sess, state.get('sidecars')):
+                            logger.info("---- Series " + str(series) + " was already placed by an earlier run")
+                            to_convert.discard(series)
+                            kept.update(state['placed'])
+                            kept.update(state['sidecars'])
+                        elif verify_files(unpacked_dir, state.get('converted')):
+                            logger.info("---- Series " + str(series) + " was already converted by an earlier run")
+                            reused[series] = index_unpacked_files([os.path.join(unpacked_dir, f) for f in state['converted']])
+                            to_convert.discard(series)
+                    prune_staged(staged_sess, kept)
+
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as block_pool:
+                place_opts = {'placement': args.placement, 
+                              'gzip_level': args.gzip_level if args.gzip else None, 
+                              'block_pool': block_pool, 
+                              'block_slots': threading.BoundedSemaphore(2 * args.jobs), 
+                              'report': report}
+                convert_and_place(input_dir, unpacked_dir, to_convert, args.jobs, cache, 
+                                  functools.partial(place_series, 
+                                                    unpacked_dir=unpacked_dir, 
+                                                    runs_by_series=runs_by_series, 
+                                                    this_sess=staged_sess, 
+                                                    fmap_apply=fmap_apply_names, 
+                                                    place_opts=place_opts, 
+                                                    journal=journal), 
+                                  scratch_dir, reused, report)
+            # The committed files are the ones placed in scratch. They are recorded again
+            # once in the BIDS tree, where a copy from scratch has a new inode.
+            committed = {}
+            for state in journal['data']['series'].values():
+                committed.update(state.get('placed', {}))
+                committed.update(state.get('sidecars', {}))
+            logger.info("Moving session into " + sess_path)
+            with timed(report, 'commit') as entry:
+                copied = commit_session(staged_sess, sess_path, 
+                                        functools.partial(dataset_metadata.update_scans, sub=bids_sub, sess=sess))
+                entry['files'] = len(committed)
+                if copied:
+                    entry['bytes_read'] = entry['bytes_written'] = sum(record['size'] for record in committed.values())
+            with timed(report, 'dataset_metadata') as entry:
+                dataset_metadata.add_participant(output_dir, bids_sub, entry)
+            with timed(report, 'journal') as entry:
+                committed = dict((relpath, file_record(os.path.join(sess_path, relpath))) for relpath in committed)
+                with journal['lock']:
+                    journal['data']['committed'] = committed
+                    journal['data']['series'] = {}
+                    save_journal(journal, entry)
+            completed = True
+            files = sorted(committed)
+    finally:
+        if completed or not args.resume:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        else:
+            logger.info("Keeping scratch directory " + scratch_dir + " for --resume")
+        scratch_lock.close()
+
+    if args.render_changes:
+        logger.info("Writing CHANGES from the change log")
+        with timed(report, 'dataset_metadata') as entry:
+            dataset_metadata.render_changes(output_dir, entry)
+
+    # ==========================================================================
+    # Validate the output dataset (only files changed since the last validation)
+    # ==========================================================================
+    num_errors = None
+    if args.validate:
+        logger.info("Validating " + output_dir)
+        with timed(report, 'validation') as entry:
+            problems, checked = bids_validate.validate_dataset(output_dir, stats=entry)
+            entry['files'] = checked
+        num_errors = bids_validate.print_problems(problems)
+        logger.info("----Checked " + str(checked) + " new or changed file(s)")
+
+    return {'sub': bids_sub, 
+            'sess': sess, 
+            'session_dir': sess_path, 
+            'runs': list(run_registry.values()), 
+            'files': files, 
+            'skipped': session_done, 
+            'validation_errors': num_errors}
+
+# Build the command-line parser (also specify help info)
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sub', 
+                        help="subject ID (e.g. RPMS2001)")
+    parser.add_argument('-e', '--sess', 
+                        help="session number")
+    parser.add_argument('-i', '--input_dir', 
+                        help="project directory where DICOM images are stored (e.g. output of xnat2proj command), " + 
+                             "or a zip/tar archive of it. Archives are read one series at a time without unpacking them.")
+    parser.add_argument('-o', '--output_dir', 
+                        help="output directory where NIFTI & JSON files will be stored in BIDS format")
+    parser.add_argument('-a', '--anat', 
+                        action='append', 
+                        nargs=2, 
+                        metavar=('RUN_NUM','FILENAME'),
+                        default=[],
+                        help="for an anatomical scan, specify the run number and the BIDS-format file name")
+    parser.add_argument('-f', '--func', 
+                        action='append', 
+                        nargs=2, 
+                        metavar=('RUN_NUM','FILENAME'),
+                        default=[],
+                        help="for a functional scan, specify the run number and the BIDS-format file name")
+    parser.add_argument('-d', '--dwi', 
+                        action='append', 
+                        nargs=2, 
+                        metavar=('RUN_NUM','FILENAME'),
+                        default=[],
+                        help="for a diffusion weighted scan, specify the run number and the BIDS-format file name")
+    parser.add_argument('-m', '--fmap', 
+                        action='append', 
+                        nargs=2, 
+                        metavar=('RUN_NUM','FILENAME'),
+                        default=[],
+                        help="for a fieldmap, specify the run number and the BIDS-format file name")
+    parser.add_argument('-n', '--intended_for',
+                        action='append',
+                        default=[],
+                        nargs='+',
+                        type=int,
+                        help="a list of integers. First indicates a fieldmap run, the rest specify which functional runs the fmap should be used with, (e.g. for distortion correction)")
+    parser.add_argument('-p', '--proj_name',
+                        default="A neuroimaging project",
+                        help="Name of project for dataset_description.json file")
+    parser.add_argument('-c', '--change', 
+                        action='append', 
+                        nargs=2, 
+                        metavar=('VERSION', 'DESCRIPTION'),
+                        default=[['9.9.9','No message provided by user regarding these changes']], 
+                        help="version number and description of changes for the CHANGES log file")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help="maximum number of series to convert with dcm2niix at the same time (default: number of CPUs)")
+    parser.add_argument('--cache_dir',
+                        default=DEFAULT_CACHE_DIR,
+                        help="directory where dcm2niix outputs are cached between runs (default: " + DEFAULT_CACHE_DIR + ")")
+    parser.add_argument('--cache_size',
+                        type=float,
+                        default=10,
+                        help="maximum size of the conversion cache in GB. Least recently used entries are removed first (default: 10)")
+    parser.add_argument('--cache_hash',
+                        action='store_true',
+                        help="include a hash of the DICOM file contents in the cache key, instead of only paths, sizes and modification times")
+    parser.add_argument('--no_cache', '--no-cache',
+                        action='store_true',
+                        help="always run dcm2niix, without reading or writing the conversion cache")
+    parser.add_argument('--placement',
+                        choices=PLACEMENT_MODES,
+                        default='copy',
+                        help="how NIfTI files are put into the BIDS directory. hardlink, reflink and move avoid copying " + 
+                             "the data and fall back to a copy across filesystems; symlink points into " + 
+                             "INPUT_DIR/UNPACKED, which is then kept (default: copy)")
+    parser.add_argument('--scratch',
+                        default=None,
+                        help="node-local directory where series are converted and the session is assembled before " + 
+                             "it is moved into --output_dir in one step. Removed when done (default: $TMPDIR)")
+    parser.add_argument('-z', '--gzip',
+                        action='store_true',
+                        help="write compressed .nii.gz files into the BIDS directory instead of .nii")
+    parser.add_argument('--gzip_level',
+                        type=int,
+                        default=6,
+                        help="gzip compression level from 1 (fastest) to 9 (smallest) used with --gzip (default: 6)")
+    parser.add_argument('--validate',
+                        action='store_true',
+                        help="check the output directory with bids_validate.py when done. Only files changed since the last check are re-checked")
+    parser.add_argument('-r', '--rules',
+                        help="JSON rules file mapping DICOM header fields (ProtocolName, SeriesDescription, ImageType) " + 
+                             "to BIDS filenames, used to add runs automatically. See dicom_headers.py")
+    parser.add_argument('--inventory',
+                        action='store_true',
+                        help="only print the series found in the DICOM headers of --input_dir (and their BIDS names with --rules), then exit")
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help="continue an interrupted run of this session from its journal: skip the dataset-level " + 
+                             "files, series and session moves that it completed and that are unchanged on disk")
+    parser.add_argument('--skip_dataset_files',
+                        action='store_true',
+                        help="do not update dataset_description.json and README or log a change (e.g. when they are written once for a batch)")
+    parser.add_argument('--dataset_files_only',
+                        action='store_true',
+                        help="only create or update dataset_description.json and README and log a change in --output_dir, then exit")
+    parser.add_argument('--render_changes',
+                        action='store_true',
+                        help="write the CHANGES file from the change log when done. Changes are otherwise only logged, " + 
+                             "so that many sessions can run at once (see dataset_metadata.py)")
+    parser.add_argument('--report',
+                        help="write a JSON report of the run to this file: wall time, bytes read and written and " + 
+                             "number of files of each stage, series and file")
+    parser.add_argument('--profile',
+                        help="profile the run with cProfile and save the statistics to this file (see pstats)")
+    parser.add_argument('--log_level',
+                        choices=LOG_LEVELS,
+                        default='INFO',
+                        help="least important messages to print: DEBUG lists every file written (default: INFO)")
+    return parser
 
 ################################################################################
 #
@@ -224,244 +1548,49 @@ def check_filename(fname, img_type):
 # MAIN SCRIPT
 #
 ################################################################################
-# ==============================================================================
-# Parse input arguments (also specify help info)
-# ==============================================================================
-print("Running unpack_to_bids.py")
-print("Parsing arguments")
-parser = argparse.ArgumentParser()
-parser.add_argument('-s', '--sub', 
-                    help="subject ID (e.g. RPMS2001)")
-parser.add_argument('-e', '--sess', 
-                    help="session number")
-parser.add_argument('-i', '--input_dir', 
-                    help="project directory where DICOM images are stored (e.g. output of xnat2proj command)")
-parser.add_argument('-o', '--output_dir', 
-                    help="output directory where NIFTI & JSON files will be stored in BIDS format")
-parser.add_argument('-a', '--anat', 
-                    action='append', 
-                    nargs=2, 
-                    metavar=('RUN_NUM','FILENAME'),
-                    default=[],
-                    help="for an anatomical scan, specify the run number and the BIDS-format file name")
-parser.add_argument('-f', '--func', 
-                    action='append', 
-                    nargs=2, 
-                    metavar=('RUN_NUM','FILENAME'),
-                    default=[],
-                    help="for a functional scan, specify the run number and the BIDS-format file name")
-parser.add_argument('-d', '--dwi', 
-                    action='append', 
-                    nargs=2, 
-                    metavar=('RUN_NUM','FILENAME'),
-                    default=[],
-                    help="for a diffusion weighted scan, specify the run number and the BIDS-format file name")
-parser.add_argument('-m', '--fmap', 
-                    action='append', 
-                    nargs=2, 
-                    metavar=('RUN_NUM','FILENAME'),
-                    default=[],
-                    help="for a fieldmap, specify the run number and the BIDS-format file name")
-parser.add_argument('-n', '--intended_for',
-                    action='append',
-                    default=[],
-                    nargs='+',
-                    type=int,
-                    help="a list of integers. First indicates a fieldmap run, the rest specify which functional runs the fmap should be used with, (e.g. for distortion correction)")
-parser.add_argument('-p', '--proj_name',
-                    default="A neuroimaging project",
-                    help="Name of project for dataset_description.json file")
-parser.add_argument('-c', '--change', 
-                    action='append', 
-                    nargs=2, 
-                    metavar=('VERSION', 'DESCRIPTION'),
-                    default=[['9.9.9','No message provided by user regarding these changes']], 
-                    help="version number and description of changes for the CHANGES log file")
-args = parser.parse_args()
-
-# Check that mandatory flags were given
-check_args(args)
-
-# Assign input arguments to more convenient variable names
-sub = args.sub
-bids_sub = re.sub('[^0-9a-zA-Z]+', '', sub) #Create a BIDS-compliant sub name, in case subject name contains non-alphanum chars
-if bids_sub != sub:
-    print("WARNING: " + sub + ", the subject name you provided, is not BIDS compliant. Using " + bids_sub + " instead.")
-sess = args.sess
-proj_name = args.proj_name
-input_dir = args.input_dir
-output_dir = args.output_dir
-anat_runs = args.anat
-dwi_runs = args.dwi
-fmap_runs = args.fmap
-func_runs = args.func
-changes = args.change
-fmap_apply = args.intended_for
-
-# ==============================================================================
-# Parse the -intended_for argument
-# ==============================================================================
-# Handle default case for Fieldmap "IntendedFor" field of json file
-# (e.g. make all fieldmaps apply to all functional scans, by default)
-if len(fmap_apply) > len(fmap_runs):
-    sys.exit("ERROR: Too many --intended_for flags. Found " + str(len(fmap_runs)) + 
-             " fieldmaps, but " + str(len(fmap_apply)) + " --intended_for flags.")
-elif len(fmap_apply) < len(fmap_runs):
-    print("WARNING: --intended_for flag not specified for all fieldmaps." + 
-          " Unspecified fieldmaps will be IntendedFor ALL functional runs")
-    for i in range(0,len(fmap_runs)):
-        intended_for = []
-        already_specified = False
-        intended_for.append(int(fmap_runs[i][0]))
-        for j in range(0,len(func_runs)):
-            intended_for.append(int(func_runs[j][0]))
-        # Check to see if IntendedFor was already specified
-        for m in range(0,len(fmap_apply)):
-            if intended_for[0] == fmap_apply[m][0]:
-                already_specified = True
-        if not already_specified:        
-            fmap_apply.append(intended_for)
-
-# Convert IntendedFor from run numbers to filenames
-fmap_apply_names = []
-for i in range(0,len(fmap_apply)):
-    names = []
-    # Append relevant fieldmap filename first
-    for j in range(0,len(fmap_runs)):
-        if fmap_apply[i][0] == int(fmap_runs[j][0]):
-            names.append(fmap_runs[j][1])
-    # Append all functional filenames next
-    for j in range(0,len(fmap_apply[i])):
-        for k in range(0,len(func_runs)):
-            if fmap_apply[i][j] == int(func_runs[k][0]):
-                names.append('ses-' + str(sess) + '/func/' + func_runs[k][1] + '.nii')
-        for k in range(0,len(anat_runs)):
-            if fmap_apply[i][j] == int(anat_runs[k][0]):
-                names.append('ses-' + str(sess) + '/anat/' + anat_runs[k][1] + '.nii')
-        for k in range(0,len(dwi_runs)):
-            if fmap_apply[i][j] == int(dwi_runs[k][0]):
-                names.append('ses-' + str(sess) + '/dwi/' + dwi_runs[k][1] + '.nii')
-    fmap_apply_names.append(names)
-
-# ==============================================================================
-# Lightweight checks that filenames are generally BIDS-compliant
-# ==============================================================================
-# Check a few things
-if not sub.isalnum():
-    print('Creating BIDS-compliant subject name...\n----Original: ' + sub + '\n----Final: ' + bids_sub)
-
-for run in anat_runs:
-    check_filename(run[1], "anat")
-
-for run in func_runs:
-    check_filename(run[1], "func")
-
-for run in dwi_runs:
-    check_filename(run[1], "dwi")
-
-for run in fmap_runs:
-    check_filename(run[1], "fmap")
-
-# ==============================================================================
-# Convert DCM to NII & JSON using dcm2niix
-# ==============================================================================
-print("Converting DICOMS to NII")
-if not os.path.exists(os.path.join(input_dir, "UNPACKED")):
-    print("----Creating Directory for unpacked Images: " + os.path.join(input_dir, "/UNPACKED"))
-    os.mkdir(os.path.join(input_dir, "UNPACKED"))
-subprocess.call(["dcm2niix", "-f", "%i_%p_%t_%s", 
-                             "-z", "n",
-                             "-o", input_dir + "/UNPACKED", 
-                             input_dir]) 
-
-# ==============================================================================
-# Create first level directories and metadata files
-# ==============================================================================
-# Create NIFTI (output) directory
-if not os.path.exists(output_dir):
-    print("Creating Output directory at: " + output_dir)
-    os.mkdir(output_dir)
-else:
-    print("Output directory exists. Using: " + output_dir)
-
-# Create or update dataset_description.json
-fpath = os.path.join(output_dir, 'dataset_description.json')
-if not os.path.exists(fpath):
-    print("Creating dataset_description.json file")
-    with open(fpath, 'w+') as outfile:
-        data = {}
-        data['Name'] = proj_name
-        data['BIDSVersion'] = BIDS_VERSION
-        outfile.seek(0)
-        json.dump(data, outfile, indent=4)
-        outfile.close()
-else:
-    print("Updating existing dataset_description.json file")
-    with open(fpath, 'r+') as outfile:
-        print("output file is %s" % outfile)
-        data = json.load(outfile)
-        data['BIDSVersion'] = BIDS_VERSION
-        outfile.seek(0)
-        json.dump(data, outfile, indent=4)
-        outfile.close()
-
-# Create or update README
-print("Creating README")
-with open(os.path.join(output_dir, 'README'), 'w+') as outfile:
-    outfile.write("Project Name: " + proj_name + "\n")
-    outfile.write("BIDS Version: " + BIDS_VERSION + "\n")
-    now = datetime.datetime.now()
-    outfile.write("This project was unpacked and put into BIDS format by unpack_to_bids.py on " + 
-                  now.strftime("%Y-%m-%d %H:%M") + "\n")
-
-# Create or update CHANGES file
-fpath = os.path.join(os.path.join(output_dir, 'CHANGES'))
-if not os.path.exists(fpath):
-    print("Creating CHANGES file")
-    with open(fpath, 'w+') as outfile:
-        outfile.write("1.0.0 " + str(datetime.date.today()) + "\n")
-        outfile.write("\t- Initial release.\n")
-        outfile.close()
-else:
-    print("Updating changes file with the message specified by the --change option:\n" + changes[-1][1])
-    prepend(fpath, 
-            (changes[-1][0] + " " + str(datetime.date.today()) + '\n' +
-             '\t- ' + changes[-1][1] + '\n'))
-
-# Make "code directory"
-fpath = os.path.join(output_dir, 'code')
-if not os.path.exists(fpath):
-    print("Creating code directory")
-    os.mkdir(fpath)
-
-# Make Subject Directory
-fpath = os.path.join(output_dir, 'sub-' + bids_sub)
-if not os.path.exists(fpath):
-    print("Creating subject directory: " + fpath)
-    os.mkdir(fpath)
-else:
-    print("Putting data in existing subject directory: " + fpath)
-
-# Make a session directory
-sess_path = os.path.join(os.path.join(output_dir, 'sub-' + bids_sub, 'ses-' + sess))
-if not os.path.exists(sess_path):
-    print("Creating new session directory: " + sess_path)
-    os.mkdir(sess_path)
-else:
-    print("Putting data in existing session directory: " + sess_path)
-
-# ==============================================================================
-# Copy individual scans into relevant locations, in BIDS format
-# ==============================================================================
-# Put the Anatomical Scans to BIDS format
-copy_to_bids(anat_runs, "anat", sess_path)
-copy_to_bids(fmap_runs, "fmap", sess_path, fmap_apply_names)
-copy_to_bids(func_runs, "func", sess_path)
-copy_to_bids(dwi_runs, "dwi", sess_path)
-
-print("SUCCESS! unpack_to_bids.py complete.\n----We recommend that you run this directory through a BIDS validator to ensure proper formatting (Just in case!)")
-
-# NEEDSWORK: Add BIDS validator?
-# NEEDSWORK: Handle event files (stim timing?)
+def main(argv = None):
+    # ==========================================================================
+    # Parse input arguments
+    # ==========================================================================
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=args.log_level)
+    logger.info("Running unpack_to_bids.py")
+
+    # Problems are reported as UnpackError by the functions above
+    try:
+        # Only write the dataset-level files, if requested
+        if args.dataset_files_only:
+            check_args(args)
+            write_dataset_files(args.output_dir, args.proj_name, args.change, args.resume, args.render_changes)
+            logger.info("SUCCESS! Dataset-level files written to " + args.output_dir)
+            return
 
+        # Only print the series found in the DICOM headers of --input_dir, if requested
+        if args.inventory:
+            import dicom_headers
+            check_args(args)
+            dicom_inventory = dicom_headers.scan_session(args.input_dir)
+            names = {}
+            if args.rules is not None:
+                rule_runs, names = dicom_headers.apply_rules(dicom_inventory, load_rules(args.rules), 
+                                                             args.sub or "SUB", args.sess or "1")
+            dicom_headers.print_inventory(dicom_inventory, names)
+            return
+
+        options = dict(vars(args))
+        for name in ['sub', 'sess', 'input_dir', 'output_dir']:
+            del options[name]
+        result = convert_session(args.sub, args.sess, args.input_dir, args.output_dir, **options)
+        if result['validation_errors'] is None:
+            logger.info("SUCCESS! unpack_to_bids.py complete.\n----We recommend that you run this directory through a BIDS validator (e.g. with --validate) to ensure proper formatting (Just in case!)")
+        elif result['validation_errors'] > 0:
+            raise UnpackError("ERROR: BIDS validation found " + str(result['validation_errors']) + " error(s) in " + args.output_dir)
+        else:
+            logger.info("SUCCESS! unpack_to_bids.py complete. No BIDS validation errors found.")
+    except UnpackError as e:
+        sys.exit(str(e))
+
+# NEEDSWORK: Handle event files (stim timing?)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+"""
+unpack_to_bids_batch.py
+
+  Author: Tom Morin
+    Date: March, 2019
+ Purpose: Run unpack_to_bids.py for many subjects/sessions listed in a manifest,
+          converting several sessions at the same time
+"""
+
+################################################################################
+#
+# IMPORT USEFUL PYTHON MODULES
+#
+################################################################################
+import sys
+import argparse
+import contextlib
+import csv
+import io
+import json
+import logging
+import os
+import time
+import traceback
+import concurrent.futures
+import bids_validate
+import dataset_metadata
+import unpack_to_bids
+
+################################################################################
+#
+# DEFINE CONSTANT VARIABLES
+#
+################################################################################
+RUN_TYPES = ['anat', 'func', 'dwi', 'fmap']
+MANIFEST_COLUMNS = ['sub', 'sess', 'input_dir'] + RUN_TYPES + ['intended_for']
+
+# Messages go through logging; main() prints them to stdout at --log_level
+logger = logging.getLogger('unpack_to_bids_batch')
+
+################################################################################
+#
+# IMPLEMENT USEFUL FUNCTIONS
+#
+################################################################################
+# Parse a TSV cell of run mappings, e.g. "18:sub-01_task-rest_bold; 20:sub-01_task-ravens_bold"
+def parse_runs_cell(cell, row_num):
+    runs = []
+    for item in cell.split(";"):
+        item = item.strip()
+        if item == "":
+            continue
+        if ":" not in item:
+            sys.exit("ERROR: Manifest row " + str(row_num) + ": run mapping '" + item +
+                     "' should look like RUN_NUM:FILENAME")
+        run_number, fname = item.split(":", 1)
+        runs.append([run_number.strip(), fname.strip()])
+    return runs
+
+# Parse a TSV cell of --intended_for groups, e.g. "11 18 20; 12 22 24"
+def parse_intended_for_cell(cell, row_num):
+    groups = []
+    for item in cell.split(";"):
+        if item.strip() == "":
+            continue
+        try:
+            groups.append([int(run) for run in item.split()])
+        except ValueError:
+            sys.exit("ERROR: Manifest row " + str(row_num) + ": --intended_for group '" + item.strip() +
+                     "' should only contain run numbers")
+    return groups
+
+# Read a TSV manifest with one session per row. Run columns use the same
+# semantics as the --anat/--func/--dwi/--fmap/--intended_for flags.
+def read_tsv_manifest(fpath):
+    sessions = []
+    with open(fpath, newline='') as infile:
+        reader = csv.DictReader(infile, delimiter='\t')
+        missing = [c for c in ['sub', 'sess', 'input_dir'] if c not in (reader.fieldnames or [])]
+        if len(missing) > 0:
+            sys.exit("ERROR: Manifest " + fpath + " is missing column(s): " + ", ".join(missing))
+        for row_num, row in enumerate(reader, start=2):
+            session = {'sub': row['sub'], 'sess': row['sess'], 'input_dir': row['input_dir']}
+            for run_type in RUN_TYPES:
+                session[run_type] = parse_runs_cell(row.get(run_type) or "", row_num)
+            session['intended_for'] = parse_intended_for_cell(row.get('intended_for') or "", row_num)
+            sessions.append(session)
+    return sessions
+
+# Read a JSON manifest: a list of sessions (or {"sessions": [...]}), each with
+# sub, sess, input_dir and optional anat/func/dwi/fmap lists of [RUN_NUM, FILENAME]
+# pairs and intended_for lists of run numbers
+def read_json_manifest(fpath):
+    with open(fpath) as infile:
+        data = json.load(infile)
+    if isinstance(data, dict):
+        data = data.get('sessions', [])
+    sessions = []
+    for i, entry in enumerate(data):
+        for key in ['sub', 'sess', 'input_dir']:
+            if key not in entry:
+                sys.exit("ERROR: Manifest entry " + str(i) + " is missing '" + key + "'")
+        session = {'sub': str(entry['sub']), 'sess': str(entry['sess']), 'input_dir': entry['input_dir']}
+        for run_type in RUN_TYPES:
+            session[run_type] = [[str(run[0]), run[1]] for run in entry.get(run_type, [])]
+        session['intended_for'] = [[int(run) for run in group] for group in entry.get('intended_for', [])]
+        sessions.append(session)
+    return sessions
+
+def read_manifest(fpath):
+    if fpath.endswith(".json"):
+        return read_json_manifest(fpath)
+    return read_tsv_manifest(fpath)
+
+# Build the unpack_to_bids.convert_session options for one session
+def session_options(session, args):
+    options = {'proj_name': args.proj_name, 
+               'jobs': args.jobs, 
+               'skip_dataset_files': True, 
+               'intended_for': session['intended_for'], 
+               'no_cache': args.no_cache, 
+               'gzip': args.gzip, 
+               'gzip_level': args.gzip_level, 
+               'scratch': args.scratch, 
+               'resume': args.resume}
+    if args.report_dir is not None:
+        options['report'] = os.path.join(args.report_dir, "sub-" + session['sub'] + "_ses-" + session['sess'] + ".json")
+    for run_type in RUN_TYPES:
+        options[run_type] = session[run_type]
+    if args.placement is not None:
+        options['placement'] = args.placement
+    return options
+
+# Convert one session in a worker process. A failing session does not stop the
+# others; its exit code and output are returned for the summary.
+def run_session(session, args):
+    start = time.time()
+    output = io.StringIO()
+    code = 0
+    # Send this session's log messages to its output only
+    handler = logging.StreamHandler(output)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    saved_handlers = root.handlers
+    root.handlers = [handler]
+    with contextlib.redirect_stdout(output):
+        try:
+            unpack_to_bids.convert_session(session['sub'], session['sess'], session['input_dir'], args.output_dir, 
+                                           **session_options(session, args))
+        except unpack_to_bids.UnpackError as e:
+            logger.error(str(e))
+            code = 1
+        except Exception:
+            traceback.print_exc(file=output)
+            code = 1
+        finally:
+            root.handlers = saved_handlers
+    write_session_log(session, args, output.getvalue())
+    return code, output.getvalue(), time.time() - start
+
+# Convert the sessions in one pool of --workers processes, submitting only as
+# many as there are workers. A worker that dies (e.g. killed for using too much
+# memory) breaks the pool and fails every session in flight, so the pool is
+# recreated and those sessions are run again one at a time: only a session that
+# breaks the pool on its own fails. Returns (session, code, output, seconds)
+# for each session, in the order they finish.
+def convert_sessions(sessions, args):
+    results = []
+    waiting = list(sessions)
+    suspects = []
+    running = {}
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+    try:
+        while len(waiting) + len(suspects) + len(running) > 0:
+            if len(suspects) > 0:
+                if len(running) == 0:
+                    session = suspects.pop(0)
+                    running[pool.submit(run_session, session, args)] = (session, pool, True, time.time())
+            else:
+                while len(waiting) > 0 and len(running) < args.workers:
+                    session = waiting.pop(0)
+                    running[pool.submit(run_session, session, args)] = (session, pool, False, time.time())
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                session, session_pool, alone, start = running.pop(future)
+                try:
+                    code, output, seconds = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    if session_pool is pool:
+                        pool.shutdown(wait=True)
+                        pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+                    if not alone:
+                        logger.warning("---- sub-" + session['sub'] + " ses-" + session['sess'] + 
+                                       ": a worker process died; running this session again on its own")
+                        suspects.append(session)
+                        continue
+                    code, seconds = 1, time.time() - start
+                    output = ("ERROR: The worker process converting sub-" + session['sub'] + " ses-" + session['sess'] + 
+                              " stopped unexpectedly (e.g. it was killed for using too much memory)\n")
+                    write_session_log(session, args, output)
+                if code == 0:
+                    logger.info("---- sub-" + session['sub'] + " ses-" + session['sess'] + ": done")
+                else:
+                    logger.error("---- sub-" + session['sub'] + " ses-" + session['sess'] + ": FAILED")
+                results.append((session, code, output, seconds))
+    finally:
+        pool.shutdown(wait=True)
+    return results
+
+def write_session_log(session, args, output):
+    if args.log_dir is not None:
+        log_name = "sub-" + session['sub'] + "_ses-" + session['sess'] + ".log"
+        with open(os.path.join(args.log_dir, log_name), 'w') as outfile:
+            outfile.write(output)
+
+def print_summary(results):
+    logger.info("\n%-20s %-8s %-16s %10s" % ("SUBJECT", "SESSION", "STATUS", "SECONDS"))
+    for session, code, output, seconds in results:
+        status = "OK" if code == 0 else "FAILED (exit " + str(code) + ")"
+        logger.info("%-20s %-8s %-16s %10.1f" % (session['sub'], session['sess'], status, seconds))
+
+################################################################################
+#
+# MAIN SCRIPT
+#
+################################################################################
+def main():
+    # ==========================================================================
+    # Parse input arguments (also specify help info)
+    # ==========================================================================
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-M', '--manifest',
+                        help="TSV or JSON manifest listing one session per row/entry. TSV columns: " +
+                             ", ".join(MANIFEST_COLUMNS))
+    parser.add_argument('-o', '--output_dir',
+                        help="output directory where NIFTI & JSON files will be stored in BIDS format")
+    parser.add_argument('-p', '--proj_name',
+                        default="A neuroimaging project",
+                        help="Name of project for dataset_description.json file")
+    parser.add_argument('-c', '--change',
+                        action='append',
+                        nargs=2,
+                        metavar=('VERSION', 'DESCRIPTION'),
+                        default=[['9.9.9','No message provided by user regarding these changes']],
+                        help="version number and description of changes for the CHANGES log file")
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help="number of sessions to convert at the same time (default: 1)")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=None,
+                        help="dcm2niix processes per session (default: number of CPUs divided by --workers)")
+    parser.add_argument('--no_cache', '--no-cache',
+                        action='store_true',
+                        help="always run dcm2niix, without reading or writing the conversion cache")
+    parser.add_argument('--placement',
+                        choices=['copy', 'hardlink', 'reflink', 'move', 'symlink'],
+                        help="how NIfTI files are put into the BIDS directory (see unpack_to_bids.py -h)")
+    parser.add_argument('--scratch',
+                        help="node-local directory where each session is assembled before it is moved into " + 
+                             "--output_dir (default: $TMPDIR)")
+    parser.add_argument('-z', '--gzip',
+                        action='store_true',
+                        help="write compressed .nii.gz files into the BIDS directory instead of .nii")
+    parser.add_argument('--gzip_level',
+                        type=int,
+                        default=6,
+                        help="gzip compression level from 1 (fastest) to 9 (smallest) used with --gzip (default: 6)")
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help="continue an interrupted batch: each session skips the work its journal shows as done")
+    parser.add_argument('--render_changes',
+                        action='store_true',
+                        help="write the CHANGES file from the change log once all sessions are done")
+    parser.add_argument('--validate',
+                        action='store_true',
+                        help="check the output directory with bids_validate.py once all sessions are done")
+    parser.add_argument('--log_dir',
+                        help="directory where the output of each session is saved")
+    parser.add_argument('--log_level',
+                        choices=unpack_to_bids.LOG_LEVELS,
+                        default='INFO',
+                        help="least important messages printed, and kept in the output of each session (default: INFO)")
+    parser.add_argument('--report_dir',
+                        help="directory where the run report of each session is saved (see unpack_to_bids.py --report)")
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=args.log_level)
+
+    if args.manifest is None:
+        sys.exit("ERROR: No --manifest argument specified")
+    if args.output_dir is None:
+        sys.exit("No --output_dir argument specified")
+    if args.workers < 1:
+        sys.exit("ERROR: --workers must be at least 1")
+    if args.jobs is None:
+        args.jobs = max(1, (os.cpu_count() or 1) // args.workers)
+
+    sessions = read_manifest(args.manifest)
+    if len(sessions) == 0:
+        sys.exit("ERROR: No sessions found in manifest " + args.manifest)
+    for dpath in [args.log_dir, args.report_dir]:
+        if dpath is not None:
+            os.makedirs(dpath, exist_ok=True)
+
+    # ==========================================================================
+    # Write dataset-level files once for the whole batch
+    # ==========================================================================
+    logger.info("Writing dataset-level files to " + args.output_dir)
+    unpack_to_bids.write_dataset_files(args.output_dir, args.proj_name, args.change, args.resume)
+
+    # ==========================================================================
+    # Convert the sessions, --workers at a time, in a pool of worker processes
+    # ==========================================================================
+    logger.info("Converting " + str(len(sessions)) + " session(s) with " + str(args.workers) + " worker(s)")
+    results = convert_sessions(sessions, args)
+
+    # Report failed sessions first, then the summary table
+    results.sort(key=lambda r: sessions.index(r[0]))
+    failed = [r for r in results if r[1] != 0]
+    for session, code, output, seconds in failed:
+        logger.error("\nOutput of failed session sub-" + session['sub'] + " ses-" + session['sess'] + ":\n" + 
+                     "\n".join(output.splitlines()[-20:]))
+    print_summary(results)
+
+    if args.render_changes:
+        logger.info("\nWriting CHANGES from the change log")
+        dataset_metadata.render_changes(args.output_dir)
+
+    if args.validate:
+        logger.info("\nValidating " + args.output_dir)
+        problems, checked = bids_validate.validate_dataset(args.output_dir)
+        num_errors = bids_validate.print_problems(problems)
+        logger.info("----Checked " + str(checked) + " new or changed file(s). Found " + str(num_errors) + " error(s).")
+        if num_errors > 0 and len(failed) == 0:
+            sys.exit("ERROR: BIDS validation found " + str(num_errors) + " error(s) in " + args.output_dir)
+
+    if len(failed) > 0:
+        sys.exit("ERROR: " + str(len(failed)) + " of " + str(len(sessions)) + " session(s) failed")
+    logger.info("SUCCESS! All " + str(len(sessions)) + " session(s) converted.")
+
+if __name__ == '__main__':
+    main()